@@ -0,0 +1,122 @@
+import os
+import csv
+import time
+import multiprocessing
+
+TSV_COLUMNS = ['file', 'tonic', 'raga', 'pitch_time', 'tonic_raga_time', 'total_time', 'error']
+
+_worker = {}
+
+
+def init_worker(tradition, tonic, threads, ensemble_profile=None):
+    # each worker builds its own TF sessions once, limited to its share of the cores
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    from core import get_crepe, get_spd_model
+    _worker['crepe'] = get_crepe(threads=threads)
+    _worker['cretora'] = get_spd_model(tradition, threads=threads)
+    if ensemble_profile:
+        _worker['cretora'].set_ensemble_profile(ensemble_profile)
+    _worker['tonic'] = tonic
+
+
+def score_file(file_path):
+    row = dict.fromkeys(TSV_COLUMNS, '')
+    row['file'] = file_path
+    try:
+        t0 = time.time()
+        # decoding overlaps with the pitch model, so pitch_time covers both
+        audio, pitches = _worker['crepe'].predict_pitches_file(file_path, keep_audio=_worker['tonic'] is None)
+        t2 = time.time()
+        pred_tonic, pred_raga = _worker['cretora'].predict_tonic_raga(_worker['crepe'], audio, pitches,
+                                                                      _worker['tonic'])
+        t3 = time.time()
+        row.update({'tonic': pred_tonic, 'raga': pred_raga,
+                    'pitch_time': '{:.3f}'.format(t2 - t0), 'tonic_raga_time': '{:.3f}'.format(t3 - t2),
+                    'total_time': '{:.3f}'.format(t3 - t0)})
+    except Exception as e:
+        row['error'] = '{}: {}'.format(type(e).__name__, e)
+    return row
+
+
+def list_batch_dir(batch_dir):
+    files = []
+    for root, _, names in os.walk(batch_dir):
+        for name in names:
+            if os.path.splitext(name)[1].lower() in ['.wav', '.mp3']:
+                files.append(os.path.join(root, name))
+    return sorted(files)
+
+
+def read_manifest(manifest):
+    """
+    One audio path per line, tab separated extra columns are ignored
+    """
+    files = []
+    with open(manifest) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                files.append(line.split('\t')[0])
+    return files
+
+
+def read_done(output):
+    """
+    Files with a complete error-free row in the output TSV, failed files and a row cut short
+    by a crash are scored again on resume
+    """
+    if not os.path.exists(output):
+        return set()
+    with open(output, newline='') as f:
+        return set(row['file'] for row in csv.DictReader(f, delimiter='\t')
+                   if row.get('error') == '' and row.get('total_time'))
+
+
+def read_header(output):
+    """
+    Columns of an existing output TSV, older runs may have written a different set
+    """
+    with open(output, newline='') as f:
+        return next(csv.reader(f, delimiter='\t'), None)
+
+
+def ends_with_newline(output):
+    with open(output, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def run_batch(files, output, tradition, tonic=None, workers=None, threads=None, ensemble_profile=None):
+    """
+    Score files over a pool of worker processes and append one TSV row per file as it finishes
+
+    Files already scored without error in the output TSV are skipped, so a crashed run resumes
+    where it stopped. ensemble_profile selects a saved raga ensemble profile in every worker.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if threads is None:
+        threads = max(1, os.cpu_count() // workers)
+
+    done = read_done(output)
+    pending = [f for f in files if f not in done]
+    print('{} files to score, {} already done'.format(len(pending), len(files) - len(pending)))
+    if not pending:
+        return
+
+    write_header = not os.path.exists(output) or os.path.getsize(output) == 0
+    fieldnames = TSV_COLUMNS if write_header else read_header(output)
+    # spawn so that workers do not inherit TF state from the parent process
+    ctx = multiprocessing.get_context('spawn')
+    with open(output, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter='\t', extrasaction='ignore')
+        if write_header:
+            writer.writeheader()
+        elif not ends_with_newline(output):
+            # the last row was cut short by a crash, the next one starts on its own line
+            f.write('\n')
+        with ctx.Pool(workers, initializer=init_worker, initargs=(tradition, tonic, threads, ensemble_profile)) as pool:
+            for i, row in enumerate(pool.imap_unordered(score_file, pending)):
+                writer.writerow(row)
+                f.flush()
+                print('[{}/{}] {} {} {}'.format(i + 1, len(pending), row['file'], row['raga'], row['error']))
@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import tracemalloc
+import numpy as np
+import data_utils
+import raga_feature
+
+SAMPLE_DIR = 'data/sample_data'
+
+
+def get_sample_files(sample_dir=SAMPLE_DIR):
+    return sorted(os.path.join(sample_dir, f) for f in os.listdir(sample_dir) if f.endswith('.wav'))
+
+
+def bench_vad(crepe, cretora, files):
+    """
+    Pitch inference speedup of the voice activity gate and agreement of the final predictions
+    """
+    results = []
+    for file_path in files:
+        audio = data_utils.load_audio(file_path)
+        t0 = time.time()
+        pitches = crepe.predict_pitches(audio, vad=False)
+        t1 = time.time()
+        pitches_vad = crepe.predict_pitches(audio, vad=True)
+        t2 = time.time()
+        skipped_fraction = crepe.skipped_fraction
+
+        tonic, raga = cretora.predict_tonic_raga(crepe, audio, pitches)
+        tonic_vad, raga_vad = cretora.predict_tonic_raga(crepe, audio, pitches_vad)
+        hist = np.mean(pitches, axis=0)
+        hist_vad = np.mean(pitches_vad, axis=0)
+        results.append({'file': file_path,
+                        'skipped_fraction': float(skipped_fraction),
+                        'pitch_time': t1 - t0,
+                        'pitch_time_vad': t2 - t1,
+                        'speedup': (t1 - t0) / max(t2 - t1, 1e-9),
+                        'hist_corr': float(np.corrcoef(hist, hist_vad)[0, 1]),
+                        'tonic_agree': tonic == tonic_vad,
+                        'raga_agree': raga == raga_vad})
+        print('{file}: skipped {skipped_fraction:.3f}, speedup {speedup:.2f}x, '
+              'tonic agree {tonic_agree}, raga agree {raga_agree}'.format(**results[-1]))
+
+    print('mean speedup {:.2f}x, tonic agreement {:.2f}, raga agreement {:.2f}'.format(
+        np.mean([r['speedup'] for r in results]), np.mean([r['tonic_agree'] for r in results]),
+        np.mean([r['raga_agree'] for r in results])))
+    return results
+
+
+def bench_cqt(files, strides=(1, 2, 4)):
+    """
+    Speed and agreement of the cached-kernel get_cqt_stats with the librosa get_cqt tonic statistics
+    """
+    results = []
+    for file_path in files:
+        audio = data_utils.load_audio(file_path)
+        t0 = time.time()
+        cqt = data_utils.get_cqt(audio)[0]
+        cqt_time = time.time() - t0
+        ref_mean = data_utils.stadardize(np.mean(cqt, 0))
+        ref_std = data_utils.stadardize(np.std(cqt, 0))
+        for stride in strides:
+            t0 = time.time()
+            fast_mean, fast_std = data_utils.get_cqt_stats(audio, stride=stride)
+            cqt_fast_time = time.time() - t0
+            fast_mean = data_utils.stadardize(fast_mean)
+            fast_std = data_utils.stadardize(fast_std)
+            results.append({'file': file_path,
+                            'stride': stride,
+                            'cqt_time': cqt_time,
+                            'cqt_fast_time': cqt_fast_time,
+                            'mean_max_diff': float(np.max(np.abs(ref_mean - fast_mean))),
+                            'std_max_diff': float(np.max(np.abs(ref_std - fast_std))),
+                            'mean_corr': float(np.corrcoef(ref_mean, fast_mean)[0, 1]),
+                            'std_corr': float(np.corrcoef(ref_std, fast_std)[0, 1])})
+            print('{file} stride {stride}: {cqt_time:.2f}s -> {cqt_fast_time:.2f}s, '
+                  'mean corr {mean_corr:.4f}, std corr {std_corr:.4f}'.format(**results[-1]))
+    return results
+
+
+def bench_tflite(crepe, crepe_tflite, cretora, files):
+    """
+    Throughput of the quantized TFLite pitch backend and agreement of its folded pitches and
+    final tonic/raga labels with the float model
+    """
+    results = []
+    for file_path in files:
+        audio = data_utils.load_audio(file_path)
+        t0 = time.time()
+        pitches = crepe.predict_pitches(audio)
+        t1 = time.time()
+        pitches_tflite = crepe_tflite.predict_pitches(audio)
+        t2 = time.time()
+
+        tonic, raga = cretora.predict_tonic_raga(crepe, audio, pitches)
+        tonic_tflite, raga_tflite = cretora.predict_tonic_raga(crepe_tflite, audio, pitches_tflite)
+        hist = np.mean(pitches, axis=0)
+        hist_tflite = np.mean(pitches_tflite, axis=0)
+        n_frames = len(pitches)
+        results.append({'file': file_path,
+                        'frames_per_sec': n_frames / max(t1 - t0, 1e-9),
+                        'frames_per_sec_tflite': n_frames / max(t2 - t1, 1e-9),
+                        'speedup': (t1 - t0) / max(t2 - t1, 1e-9),
+                        'pitch_max_diff': float(np.max(np.abs(pitches - pitches_tflite))),
+                        'argmax_agree': float(np.mean(np.argmax(pitches, 1) == np.argmax(pitches_tflite, 1))),
+                        'hist_corr': float(np.corrcoef(hist, hist_tflite)[0, 1]),
+                        'tonic_agree': tonic == tonic_tflite,
+                        'raga_agree': raga == raga_tflite})
+        print('{file}: {frames_per_sec:.0f} -> {frames_per_sec_tflite:.0f} frames/s, argmax agree '
+              '{argmax_agree:.3f}, tonic agree {tonic_agree}, raga agree {raga_agree}'.format(**results[-1]))
+
+    print('mean speedup {:.2f}x, argmax agreement {:.3f}, tonic agreement {:.2f}, raga agreement {:.2f}'.format(
+        np.mean([r['speedup'] for r in results]), np.mean([r['argmax_agree'] for r in results]),
+        np.mean([r['tonic_agree'] for r in results]), np.mean([r['raga_agree'] for r in results])))
+    return results
+
+
+STAGES = ['load', 'frames', 'pitch', 'hist_cqt', 'tonic', 'stretch', 'spd', 'knn']
+
+
+def run_stage(file_result, name, fn, *args):
+    # tracing slows allocation-heavy stages down, so a stage is either timed or traced, never both
+    if tracemalloc.is_tracing():
+        # restarted so the peak only covers the allocations of this stage
+        tracemalloc.stop()
+        tracemalloc.start()
+        out = fn(*args)
+        file_result[name] = {'peak_mb': tracemalloc.get_traced_memory()[1] / 1024 ** 2}
+    else:
+        t0 = time.perf_counter()
+        out = fn(*args)
+        file_result[name] = {'time': time.perf_counter() - t0}
+    return out
+
+
+def run_stages(crepe, cretora, file_path, trace=False):
+    """
+    Stage wall times of one file prediction, or with trace the stage peak traced memory instead
+    """
+    if trace:
+        tracemalloc.start()
+    try:
+        return run_file_stages(crepe, cretora, file_path)
+    finally:
+        tracemalloc.stop()
+
+
+def run_file_stages(crepe, cretora, file_path):
+    file_result = {'file': file_path}
+    audio = run_stage(file_result, 'load', data_utils.load_audio, file_path)
+    file_result['audio_seconds'] = len(audio) / 16000
+    run_stage(file_result, 'frames', data_utils.audio_2_frames, audio, crepe.pitch_config)
+    pitches = run_stage(file_result, 'pitch', crepe.predict_pitches, audio)
+    hist_cqt = run_stage(file_result, 'hist_cqt', data_utils.get_hist_cqt, audio, pitches,
+                         cretora.tonic_config['cqt_stride'])
+    pred_tonic = run_stage(file_result, 'tonic', cretora.predict_tonic_from_hist, hist_cqt)
+    _, tonic = cretora.get_tonic_from_pred(pred_tonic[0])
+    pitchvalue_prob = run_stage(file_result, 'stretch', crepe.stretch, pitches)
+    pitchvalue_prob = np.roll(pitchvalue_prob, -tonic * 2, axis=1)
+    spd_cache = run_stage(file_result, 'spd', raga_feature.generate_full_spd_cache, pitchvalue_prob)
+    run_stage(file_result, 'knn', cretora.predict_raga_proba, [spd_cache])
+    return file_result
+
+
+def bench_stages(crepe, cretora, files, n_warmup=1):
+    """
+    Wall time, throughput (seconds of audio per second) and peak traced memory of every stage
+    of a file prediction, per file and summed over files
+
+    The first n_warmup files are run once untimed so graph and model loading is not counted.
+    Every file is run twice, once timed with tracemalloc off and once traced for the peaks.
+    """
+    for file_path in files[:n_warmup]:
+        run_stages(crepe, cretora, file_path)
+
+    file_results = []
+    for file_path in files:
+        file_result = run_stages(crepe, cretora, file_path)
+        traced = run_stages(crepe, cretora, file_path, trace=True)
+        for stage in STAGES:
+            file_result[stage]['peak_mb'] = traced[stage]['peak_mb']
+        file_results.append(file_result)
+    audio_seconds = sum(r['audio_seconds'] for r in file_results)
+    stages = {}
+    for stage in STAGES:
+        stage_time = sum(r[stage]['time'] for r in file_results)
+        stages[stage] = {'time': stage_time,
+                         'audio_sec_per_sec': audio_seconds / max(stage_time, 1e-9),
+                         'peak_mb': max(r[stage]['peak_mb'] for r in file_results)}
+        print('{:10s} {:8.2f}s {:10.1f} audio s/s {:8.1f} MB'.format(
+            stage, stage_time, stages[stage]['audio_sec_per_sec'], stages[stage]['peak_mb']))
+    total_time = sum(s['time'] for s in stages.values())
+    print('total {:.2f}s for {:.0f}s of audio ({:.1f} audio s/s)'.format(
+        total_time, audio_seconds, audio_seconds / max(total_time, 1e-9)))
+    # ru_maxrss is in KB on linux, it includes the TF and model memory tracemalloc does not see
+    return {'audio_seconds': audio_seconds,
+            'total_time': total_time,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'stages': stages,
+            'files': file_results}
+
+
+def compare_to_baseline(results, baseline, tolerance=0.1):
+    """
+    Stages more than tolerance slower (or with a higher peak memory) than the baseline results
+    """
+    regressions = []
+    for stage in STAGES:
+        if stage not in baseline['stages']:
+            continue
+        for key in ['time', 'peak_mb']:
+            base = baseline['stages'][stage][key]
+            curr = results['stages'][stage][key]
+            ratio = curr / max(base, 1e-9)
+            print('{:10s} {:8s} {:10.3f} -> {:10.3f} ({:+.1%})'.format(stage, key, base, curr, ratio - 1))
+            if ratio > 1 + tolerance:
+                regressions.append({'stage': stage, 'metric': key, 'baseline': base, 'current': curr})
+    for r in regressions:
+        print('REGRESSION {stage} {metric}: {baseline:.3f} -> {current:.3f}'.format(**r))
+    return regressions
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('benchmark', choices=['vad', 'cqt', 'tflite', 'stages'],
+                            help='selects the benchmark to run')
+    arg_parser.add_argument('--tradition', default='h',
+                            help='sets the tradition - [h]industani/[c]arnatic')
+    arg_parser.add_argument('--sample_dir', default=SAMPLE_DIR,
+                            help='runs the benchmark on the wav files in this directory')
+    arg_parser.add_argument('--json', default=None,
+                            help='writes the results to this json file')
+    arg_parser.add_argument('--baseline', default=None,
+                            help='compares the stages benchmark to the json results of an earlier run')
+    arg_parser.add_argument('--tolerance', default=0.1,
+                            help='sets the relative slowdown over the baseline reported as a regression')
+    p_args = arg_parser.parse_args()
+
+    files = get_sample_files(p_args.sample_dir)
+
+    if p_args.benchmark == 'vad':
+        from core import CRePE, SPD_Model
+        crepe = CRePE()
+        cretora = SPD_Model('Hindustani' if p_args.tradition == 'h' else 'Carnatic')
+        results = bench_vad(crepe, cretora, files)
+    elif p_args.benchmark == 'cqt':
+        results = bench_cqt(files)
+    elif p_args.benchmark == 'tflite':
+        from core import CRePE, SPD_Model
+        crepe = CRePE(backend='keras')
+        crepe_tflite = CRePE(backend='tflite')
+        cretora = SPD_Model('Hindustani' if p_args.tradition == 'h' else 'Carnatic')
+        results = bench_tflite(crepe, crepe_tflite, cretora, files)
+    elif p_args.benchmark == 'stages':
+        from core import CRePE, SPD_Model
+        crepe = CRePE()
+        cretora = SPD_Model('Hindustani' if p_args.tradition == 'h' else 'Carnatic')
+        results = bench_stages(crepe, cretora, files)
+
+    if p_args.json:
+        with open(p_args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if p_args.baseline and p_args.benchmark == 'stages':
+        with open(p_args.baseline) as f:
+            baseline = json.load(f)
+        if compare_to_baseline(results, baseline, float(p_args.tolerance)):
+            sys.exit(1)
@@ -12,13 +12,18 @@ from tensorflow.keras.layers import Input, Reshape, Conv2D, BatchNormalization,
 from tensorflow.keras.layers import MaxPool2D, Dropout, Permute, Flatten, Dense, MaxPool1D
 from tensorflow.keras.models import Model
 import raga_feature
+import knn_index
+import inference_export
+from model_registry import registry
+import instrumentation
+import logging
 import pyhocon
 import os
+import threading
 import pandas as pd
-from pydub import AudioSegment
-from resampy import resample
 os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 import pickle
+import json
 import matplotlib.pyplot as plt
 
 models = {
@@ -32,19 +37,74 @@ import data_utils
 
 standard_tonic = ['C','C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
 
+logger = logging.getLogger(__name__)
+
+def get_interp_table(fn, tn):
+    """
+    Left/right source bin and weight of every output bin of CRePE.interp1d, the endpoint gets
+    weight 0 so the rows come out exactly as np.interp computes them
+    """
+    x = np.linspace(0, fn - 1, num=tn)
+    lo = np.floor(x).astype(np.int64)
+    hi = np.minimum(lo + 1, fn - 1)
+    return lo, hi, x - lo
+
+
+stretch_table = get_interp_table(60, 120)
+
+# keras layer construction is not thread safe, graphs are built one at a time when preloading
+graph_build_lock = threading.Lock()
+
+
+def get_session_config(threads=None):
+    """
+    Session config limiting TF to the given number of intra-op threads, None keeps the TF default
+    """
+    if threads is None:
+        return None
+    return tf.compat.v1.ConfigProto(intra_op_parallelism_threads=threads,
+                                    inter_op_parallelism_threads=min(threads, 2))
+
+
 class CRePE:
-    def __init__(self):
+    def __init__(self, threads=None, backend=None):
+        """
+        backend (default experiments.conf pitch.backend) is 'keras', 'tflite' for the quantized
+        model written by export_tflite_pitch_model, or 'auto' for the frozen graph of
+        export_inference_models when it exists and keras otherwise
+        """
         pitch_config = pyhocon.ConfigFactory.parse_file("experiments.conf")['pitch']
-        self.graph = tf.Graph()
-        self.sess = tf.compat.v1.Session(graph=self.graph)
-        # pitch_model = tf.keras.models.load_model('model/pitch/model-full.h5')
-        # pitch_model = self.build_model(pitch_config)
-        # pitch_model.load_weights('model/model-full.h5')
-        # pitch_model.save('model/pitch/model-full.h5')
-        with self.sess.as_default():
-            with self.graph.as_default():
-                pitch_model = self.build_model(pitch_config)
-                pitch_model.load_weights('model/model-full.h5', by_name=True)
+        if backend is None:
+            backend = pitch_config.get('backend', 'auto')
+        if backend not in ['keras', 'auto', 'tflite']:
+            raise ValueError('backend should be keras, auto or tflite, got {}'.format(backend))
+        frozen_path = pitch_config.get('frozen_model', None)
+        self.backend = backend
+        # the artifact the pitches come from, part of the FeatureCache key
+        self.model_path = 'model/model-full.h5'
+        if backend == 'tflite':
+            self.model_path = self.get_tflite_path(pitch_config)
+            pitch_model = inference_export.TFLiteModel(self.model_path, threads)
+            self.graph = None
+            self.sess = None
+        elif backend == 'auto' and frozen_path and os.path.exists(frozen_path):
+            # inference graph written by export_inference_models, nothing is built in python
+            self.model_path = frozen_path
+            pitch_model = inference_export.FrozenModel(frozen_path, 'x_input', 'pitch',
+                                                       get_session_config(threads))
+            self.graph = pitch_model.graph
+            self.sess = pitch_model.sess
+        else:
+            self.graph = tf.Graph()
+            self.sess = tf.compat.v1.Session(graph=self.graph, config=get_session_config(threads))
+            # pitch_model = tf.keras.models.load_model('model/pitch/model-full.h5')
+            # pitch_model = self.build_model(pitch_config)
+            # pitch_model.load_weights('model/model-full.h5')
+            # pitch_model.save('model/pitch/model-full.h5')
+            with graph_build_lock, self.sess.as_default():
+                with self.graph.as_default():
+                    pitch_model = self.build_model(pitch_config)
+                    pitch_model.load_weights(self.model_path, by_name=True)
 
         # tf.keras.backend.clear_session()
         # self.graph_pitch = tf.Graph()
@@ -55,14 +115,22 @@ class CRePE:
         self.pitch_model = pitch_model
         self.pitch_config = pitch_config
 
+    def get_tflite_path(self, pitch_config, quantization=None):
+        if quantization is None:
+            quantization = pitch_config['tflite_quantization']
+        return pitch_config['tflite_model'].format(quantization)
+
     def interp1d(self, array: np.ndarray, fn, tn) -> np.ndarray:
         return np.interp(np.linspace(0, fn - 1, num=tn), np.arange(fn), array)
 
     def stretch(self, pitches):
-        pitches_exp = np.zeros([pitches.shape[0], 120])
-        for idx, p in enumerate(pitches):
-            pitches_exp[idx] = self.interp1d(p, 60, 120)
-        return pitches_exp
+        """
+        interp1d of every row from 60 to 120 bins, as two gathers on the precomputed stretch_table
+        """
+        lo, hi, w = stretch_table
+        pitches = np.asarray(pitches, dtype=np.float64)
+        pitches_lo = pitches[:, lo]
+        return (pitches[:, hi] - pitches_lo) * w + pitches_lo
 
     def build_model(self, config):
         model_capacity = config['model_capacity']
@@ -80,24 +148,98 @@ class CRePE:
         pitch_model = Model(inputs=[x_batch], outputs=y)
         return pitch_model
 
-    def predict_pitches(self, audio):
-        frames = data_utils.audio_2_frames(audio, self.pitch_config)
-        with self.sess.as_default():
-            with self.graph.as_default():
-                p = self.pitch_model.predict(frames)
-                print("Pitch Prediction Completed")
+    def predict_pitches(self, audio, vad=None):
+        """
+        Folded 60 bin pitch values of every frame, with vad (default experiments.conf pitch.vad)
+        the frames rejected by data_utils.get_voiced_mask are skipped and their fraction is kept
+        in self.skipped_fraction
+        """
+        if vad is None:
+            vad = self.pitch_config.get('vad', False)
+        chunk_frames = self.pitch_config.get('chunk_frames', 4096)
+        self.skipped_fraction = 0.0
+        voiced = None
+        with instrumentation.span('predict_pitches'):
+            if vad:
+                with instrumentation.span('vad'):
+                    voiced = data_utils.get_voiced_mask(audio, self.pitch_config)
+                if np.any(voiced):
+                    self.skipped_fraction = 1 - np.mean(voiced)
+                    instrumentation.count('frames_skipped', int(np.sum(~voiced)))
+                else:
+                    voiced = None
+
+            frame_chunks = data_utils.audio_2_frame_chunks(audio, self.pitch_config, chunk_frames)
+            pitches = self.predict_frame_chunks(frame_chunks, voiced, chunk_frames)
 
-        pitches = np.sum(np.reshape(p, [-1,6,60]),1)
         # cents = data_utils.to_local_average_cents(p)
         # frequencies = 10 * 2 ** (cents / 1200)
         # pitches = [data_utils.freq_to_cents(freq) for freq in frequencies]
         # pitches = np.sum(np.reshape(pitches, [-1,6,60]),1)
         # plt.plot(np.mean(pitches, axis=0))
         # plt.show()
-        print('Argmax')
-        print(np.argmax(np.mean(pitches, axis=0)))
+        logger.debug('pitch histogram argmax %s', np.argmax(np.mean(pitches, axis=0)))
         return pitches
 
+    def predict_pitches_stream(self, blocks):
+        """
+        predict_pitches over a stream of 16 kHz audio blocks (see data_utils.iter_audio_blocks)
+
+        The voice activity gate needs the loudest frame of the whole recording and is not applied here,
+        use predict_pitches_file to get the same pitches as predict_pitches when pitch.vad is set
+        """
+        if self.pitch_config.get('vad', False):
+            logger.warning('pitch.vad is not applied to streamed audio, every frame is predicted')
+        chunk_frames = self.pitch_config.get('chunk_frames', 4096)
+        frame_chunks = data_utils.blocks_2_frame_chunks(blocks, self.pitch_config, chunk_frames)
+        self.skipped_fraction = 0.0
+        with instrumentation.span('predict_pitches_stream'):
+            return self.predict_frame_chunks(frame_chunks)
+
+    def predict_pitches_file(self, file_path, keep_audio=True):
+        """
+        (audio, pitches) of an audio file, the file is decoded block by block while CRePE runs
+
+        With keep_audio the decoded blocks are also collected into audio for the tonic CQT,
+        otherwise audio is None. With pitch.vad the whole file is decoded first, the voice
+        activity gate needs its loudest frame, and predict_pitches is used.
+        """
+        if self.pitch_config.get('vad', False):
+            audio = data_utils.load_audio(file_path)
+            return audio, self.predict_pitches(audio)
+        blocks = []
+
+        def iter_blocks():
+            for block in data_utils.iter_audio_blocks(file_path):
+                if keep_audio:
+                    blocks.append(block)
+                yield block
+
+        pitches = self.predict_pitches_stream(iter_blocks())
+        audio = np.concatenate(blocks) if keep_audio else None
+        return audio, pitches
+
+    def predict_frame_chunks(self, frame_chunks, voiced=None, chunk_frames=None):
+        # each chunk is reduced to its 60 bin rows right away, the 360 bin activations never pile up
+        pitches = []
+        for i, frames in enumerate(frame_chunks):
+            if voiced is not None:
+                frames = frames[voiced[i * chunk_frames:(i + 1) * chunk_frames]]
+            if len(frames) > 0:
+                pitches.append(self.predict_frames(frames))
+        return np.concatenate(pitches)
+
+    def predict_frames(self, frames):
+        instrumentation.count('frames', len(frames))
+        with instrumentation.span('pitch_model'):
+            if self.sess is None:
+                p = self.pitch_model.predict(frames)
+            else:
+                with self.sess.as_default():
+                    with self.graph.as_default():
+                        p = self.pitch_model.predict(frames)
+        return np.sum(np.reshape(p, [-1,6,60]),1)
+
     def get_pitch_emb(self, x, n_seq, n_frames, model_capacity):
         capacity_multiplier = {
             'tiny': 4, 'small': 8, 'medium': 16, 'large': 24, 'full': 32
@@ -161,16 +303,165 @@ class CRePE:
         return y, den.weights[0]
 
 
+def export_inference_models(tradition, sample_file=None):
+    """
+    Write the frozen pitch and tonic graphs of inference_export and check them against the
+    keras models on sample_file (random audio without one), returns the max output differences
+
+    Raises ValueError when a graph is off by more than the frozen_tolerance of its config,
+    the graphs are only moved to their frozen_model paths once both checks pass
+    """
+    crepe = CRePE(backend='keras')
+    spd_model = SPD_Model(tradition)
+    graph_tonic, sess_tonic, tonic_model = spd_model.load_tonic_model(frozen=False)
+    roll_idx, unroll = spd_model.get_tonic_unroll(spd_model.get_tonic_rotations(spd_model.tonic_config['rotations']))
+
+    with crepe.sess.as_default():
+        with crepe.graph.as_default():
+            pitch_graph = inference_export.build_pitch_graph(crepe.pitch_model)
+    with sess_tonic.as_default():
+        with graph_tonic.as_default():
+            tonic_graph = inference_export.build_tonic_graph(tonic_model, roll_idx, unroll)
+    pitch_path = crepe.pitch_config['frozen_model']
+    tonic_path = spd_model.get_tonic_frozen_path()
+    inference_export.save_graph(pitch_graph, pitch_path + '.tmp')
+    inference_export.save_graph(tonic_graph, tonic_path + '.tmp')
+
+    if sample_file is not None:
+        audio = data_utils.load_audio(sample_file)
+    else:
+        audio = np.random.RandomState(0).randn(16000 * 30).astype(np.float32)
+    frames = next(data_utils.audio_2_frame_chunks(audio, crepe.pitch_config, 1024))
+    pitches = crepe.predict_pitches(audio)
+    hist_cqt = data_utils.get_hist_cqt(audio, pitches, spd_model.tonic_config['cqt_stride'])
+
+    try:
+        frozen_pitch = inference_export.FrozenModel(pitch_path + '.tmp', 'x_input', 'pitch')
+        frozen_tonic = inference_export.FrozenModel(tonic_path + '.tmp', 'hist_cqt_input', 'tonic')
+        with crepe.sess.as_default():
+            with crepe.graph.as_default():
+                pitch_diff = inference_export.check_max_diff('pitch model', crepe.pitch_model, frozen_pitch, frames,
+                                                             crepe.pitch_config['frozen_tolerance'])
+        with sess_tonic.as_default():
+            with graph_tonic.as_default():
+                tonic_diff = inference_export.check_max_diff('{} tonic model'.format(tradition), tonic_model,
+                                                             frozen_tonic, hist_cqt,
+                                                             spd_model.tonic_config['frozen_tolerance'])
+    except Exception:
+        os.remove(pitch_path + '.tmp')
+        os.remove(tonic_path + '.tmp')
+        raise
+    os.replace(pitch_path + '.tmp', pitch_path)
+    os.replace(tonic_path + '.tmp', tonic_path)
+    return {'pitch': pitch_diff, 'tonic': tonic_diff}
+
+
+def export_tflite_pitch_model(quantization=None, sample_dir='data/sample_data', n_calibration=2000):
+    """
+    Convert the pitch model to a post-training quantized TFLite model, int8 activation ranges are
+    calibrated on n_calibration frames spread over the wav files in sample_dir
+
+    The quantized model is checked against keras on the same frames and ValueError is raised,
+    without writing it, when it is off by more than pitch.tflite_tolerance
+    """
+    crepe = CRePE(backend='keras')
+    if quantization is None:
+        quantization = crepe.pitch_config['tflite_quantization']
+    with crepe.sess.as_default():
+        with crepe.graph.as_default():
+            pitch_graph = inference_export.build_pitch_graph(crepe.pitch_model)
+
+    files = sorted(os.path.join(sample_dir, f) for f in os.listdir(sample_dir) if f.endswith('.wav'))
+    calibration_frames = []
+    for file_path in files:
+        audio = data_utils.load_audio(file_path)
+        frames = np.concatenate(list(data_utils.audio_2_frame_chunks(audio, crepe.pitch_config)))
+        idx = np.linspace(0, len(frames) - 1, max(1, n_calibration // len(files))).astype(int)
+        calibration_frames.append(frames[idx])
+    calibration_frames = np.concatenate(calibration_frames)
+
+    tflite_model = inference_export.convert_to_tflite(pitch_graph, 'x_input', 'pitch', quantization,
+                                                      calibration_frames)
+    path = crepe.get_tflite_path(crepe.pitch_config, quantization)
+    inference_export.save_tflite(tflite_model, path + '.tmp')
+    try:
+        with crepe.sess.as_default():
+            with crepe.graph.as_default():
+                inference_export.check_max_diff('{} tflite pitch model'.format(quantization), crepe.pitch_model,
+                                                inference_export.TFLiteModel(path + '.tmp'), calibration_frames,
+                                                crepe.pitch_config['tflite_tolerance'])
+    except Exception:
+        os.remove(path + '.tmp')
+        raise
+    os.replace(path + '.tmp', path)
+    print('wrote {} ({:.1f} MB)'.format(path, len(tflite_model) / 1024 ** 2))
+    return path
+
+
+class KNNModels:
+    """
+    wd -> KNN model mapping of a tradition, every model is loaded through the registry on first access
+    """
+
+    def __init__(self, tradition, wds=range(0,250,10)):
+        self.tradition = tradition
+        self.wds = list(wds)
+
+    def get_key(self, wd):
+        return 'knn/{}/{}'.format(self.tradition, wd)
+
+    def get_loaders(self, wds=None):
+        if wds is None:
+            wds = self.wds
+        return [(self.get_key(wd), lambda wd=wd: knn_index.load_knn_model(self.tradition, wd)) for wd in wds]
+
+    def __getitem__(self, wd):
+        if wd not in self.wds:
+            raise KeyError(wd)
+        return registry.get(self.get_key(wd), lambda: knn_index.load_knn_model(self.tradition, wd))
+
+    def __contains__(self, wd):
+        return wd in self.wds
+
+    def __len__(self):
+        return len(self.wds)
+
+    def keys(self):
+        return list(self.wds)
+
+
+def get_crepe(threads=None, backend=None):
+    """
+    The process-wide CRePE of a backend, threads only applies to the call that loads it
+    """
+    return registry.get('crepe' if backend is None else 'crepe/{}'.format(backend), lambda: CRePE(threads, backend))
+
+
+def get_spd_model(tradition, threads=None):
+    return registry.get('spd/{}'.format(tradition), lambda: SPD_Model(tradition, threads))
+
+
+def preload_models(tradition, tonic=True, crepe=False, background=True):
+    """
+    Load what predicting a tradition needs, by default in a background thread while the
+    caller builds CRePE and predicts pitches. The tonic model is skipped when tonic is False.
+    """
+    spd_model = get_spd_model(tradition)
+    items = spd_model.knn_models.get_loaders(spd_model.ensemble_wds)
+    if tonic:
+        items.append(('tonic/{}'.format(tradition), spd_model.load_tonic_model))
+    if crepe:
+        items.append(('crepe', CRePE))
+    return registry.preload(items, background)
+
+
 class SPD_Model:
 
-    def __init__(self, tradition):
-        self.graph_tonic = tf.Graph()
-        self.sess_tonic = tf.compat.v1.Session(graph=self.graph_tonic)
-        with self.sess_tonic.as_default():
-            with self.graph_tonic.as_default():
-                tonic_config = pyhocon.ConfigFactory.parse_file("experiments.conf")['tonic']
-                self.tonic_model = self.build_and_load_model(tonic_config, 'tonic', tradition)
-                self.tonic_model.load_weights('model/{}_tonic_model.hdf5'.format(tradition))
+    def __init__(self, tradition, threads=None):
+        # the tonic graph and the KNN models are loaded through the registry on first use
+        self.tradition = tradition
+        self.threads = threads
+        self.tonic_config = pyhocon.ConfigFactory.parse_file("experiments.conf")['tonic']
         if tradition == 'Carnatic':
             self.models_weights = [0.21073548, 0.09824791, -0.11856023, 0.10903256,
                                    0.071041666, 0.029498437, 0.058856107, 0.005804086,
@@ -187,9 +478,53 @@ class SPD_Model:
                                    -0.09560222, -0.116639435, 0.13686526, 0.14130622, 0.2870755]
 
         raga_config = pyhocon.ConfigFactory.parse_file("experiments.conf")['raga']
+        self.raga_config = raga_config
         self.raga_list = self.get_raga_list(raga_config, tradition)
         self.knn_models = self.build_and_load_model(raga_config, 'raga', tradition)
+        self.ensemble_wds = list(range(0,250,10))
+        self.set_ensemble_profile(raga_config.get('ensemble_profile', 'full'))
 
+    def get_ensemble_profile_path(self, name):
+        return self.raga_config['ensemble_profile_path'].format(self.tradition, name)
+
+    def set_ensemble_profile(self, name):
+        """
+        Use the wd subset and weights of a profile written by ensemble_pruning, 'full' keeps all 25 models
+        """
+        if name == 'full':
+            return
+        with open(self.get_ensemble_profile_path(name)) as f:
+            profile = json.load(f)
+        self.ensemble_wds = profile['wds']
+        self.models_weights = profile['weights']
+
+    def predict_raga_proba(self, spd_caches):
+        return raga_feature.get_raga_feat_and_predict_batch(self.knn_models, spd_caches, len(self.raga_list),
+                                                            self.ensemble_wds)
+
+
+    def get_tonic_frozen_path(self):
+        return self.tonic_config['frozen_model'].format(self.tradition, self.tonic_config['rotations'])
+
+    def load_tonic_model(self, frozen=True):
+        frozen_path = self.get_tonic_frozen_path()
+        if frozen and os.path.exists(frozen_path):
+            tonic_model = inference_export.FrozenModel(frozen_path, 'hist_cqt_input', 'tonic',
+                                                       get_session_config(self.threads))
+            return tonic_model.graph, tonic_model.sess, tonic_model
+        graph_tonic = tf.Graph()
+        sess_tonic = tf.compat.v1.Session(graph=graph_tonic, config=get_session_config(self.threads))
+        with graph_build_lock, sess_tonic.as_default():
+            with graph_tonic.as_default():
+                tonic_model = self.build_and_load_model(self.tonic_config, 'tonic_batch', self.tradition)
+                tonic_model.load_weights('model/{}_tonic_model.hdf5'.format(self.tradition))
+        return graph_tonic, sess_tonic, tonic_model
+
+    def get_tonic_model(self):
+        """
+        (graph, session, model) of the batched tonic model, shared by all SPD_Models of the tradition
+        """
+        return registry.get('tonic/{}'.format(self.tradition), self.load_tonic_model)
 
     def build_and_load_model(self, config, task, tradition):
         """
@@ -225,12 +560,15 @@ class SPD_Model:
 
             return tonic_model
 
+        elif task == 'tonic_batch':
+            # same layers as 'tonic', so the tonic weights load unchanged
+            hist_cqt_batch = Input(shape=(60,4), name='hist_cqt_input', dtype='float32')
+            rotations = self.get_tonic_rotations(config['rotations'])
+            tonic_logits = self.get_tonic_emb_batch(hist_cqt_batch, note_dim, rotations, 0.6)
+            return Model(inputs=[hist_cqt_batch], outputs=[tonic_logits])
+
         elif task == 'raga':
-            knn_models = {}
-            for wd in range(0,250,10):
-                with open('data/RagaDataset/{}/model/spd_knn_{}.pkl'.format(tradition, wd), 'rb') as f:
-                    knn_models[wd] = pickle.load(f)
-            return knn_models
+            return KNNModels(tradition)
 
     def get_hist_emb(self, hist_cqt, note_dim, indices, topk, drop_rate=0.2):
         # hist_cc = [tf.cast(self.standardize(h), tf.float32) for h in hist_cqt]
@@ -241,6 +579,9 @@ class SPD_Model:
             hist_cc_trans = tf.roll(hist_cc, -indices[i], axis=0)
             hist_cc_all.append(hist_cc_trans)
         hist_cc_all = tf.stack(hist_cc_all)
+        return self.get_rotated_hist_emb(hist_cc_all, note_dim, drop_rate)
+
+    def get_rotated_hist_emb(self, hist_cc_all, note_dim, drop_rate=0.2):
         hist_cc_all = Dropout(0.2)(hist_cc_all)
 
         d = 1
@@ -271,6 +612,44 @@ class SPD_Model:
         tonic_logits = tf.roll(tonic_logits,0,axis=1, name='tonic')
         return tonic_logits
 
+    def get_tonic_rotations(self, n_rotations):
+        """
+        n_rotations fixed shifts spread evenly over the 60 tonic bins
+        """
+        n_rotations = min(max(int(n_rotations), 1), 60)
+        return np.unique(np.round(np.arange(n_rotations) * 60 / n_rotations).astype(int))
+
+    def get_tonic_unroll(self, rotations):
+        """
+        roll_idx [R, 60] gathers tf.roll(hist, -r) for every rotation, roll_idx[r, j] = (j + r) % 60,
+        unroll [R, 60, 60] rolls the logits back by r and averages them over the rotations
+        """
+        n_rot = len(rotations)
+        roll_idx = (np.arange(60)[np.newaxis, :] + np.asarray(rotations)[:, np.newaxis]) % 60
+        unroll = np.zeros([n_rot, 60, 60], dtype=np.float32)
+        for i in range(n_rot):
+            unroll[i, np.arange(60), roll_idx[i]] = 1.0 / n_rot
+        return roll_idx, unroll
+
+    def get_tonic_emb_batch(self, hist_cqt_batch, note_dim, rotations, drop_rate=0.2):
+        """
+        Deterministic, batched version of get_tonic_emb
+
+        Every clip of the [N, 60, 4] batch is rolled by each of the fixed rotations, the N * R
+        rolled histograms go through the CNN as one batch and their logits are rolled back
+        and averaged per clip, giving [N, 60].
+        """
+        n_rot = len(rotations)
+        roll_idx, unroll = self.get_tonic_unroll(rotations)
+        hist_cc_all = tf.gather(hist_cqt_batch, roll_idx, axis=1)
+        hist_cc_all = tf.reshape(hist_cc_all, [-1, 60, 4])
+        hist_emb = self.get_rotated_hist_emb(hist_cc_all, note_dim, drop_rate)
+
+        tonic_logits = Dense(60, activation='sigmoid')(hist_emb)
+        tonic_logits = tf.reshape(tonic_logits, [-1, n_rot, 60])
+        tonic_logits = tf.einsum('nri,rij->nj', tonic_logits, unroll, name='tonic')
+        return tonic_logits
+
     def convolution_block(self, d, input_data, ks, f, drop_rate):
         if d==1:
             z = Conv1D(filters=f, kernel_size=ks, strides=1, padding='same', activation='relu')(input_data)
@@ -294,42 +673,126 @@ class SPD_Model:
         min_z = tf.reduce_min(z)
         return (z - min_z) / (tf.reduce_max(z) - min_z)
 
-    def  predict_tonic_raga(self, crepe, audio, pitchvalue_prob, tonic=None):
-        if tonic is None:
-            hist_cqt = data_utils.get_hist_cqt(audio, pitchvalue_prob)
-            with self.sess_tonic.as_default():
-                with self.graph_tonic.as_default():
-                    pred_tonic = self.tonic_model.predict(hist_cqt)[0]
-                    print("Tonic Prediction Complete")
+    def  predict_tonic_raga(self, crepe, audio, pitchvalue_prob, tonic=None, cache=None, cache_key=None):
+        with instrumentation.span('predict_tonic_raga'):
+            if tonic is None:
+                hist_cqt = None
+                if cache is not None:
+                    hist_cqt = cache.load(cache_key, self.get_hist_cqt_name())
+                if hist_cqt is None:
+                    hist_cqt = data_utils.get_hist_cqt(audio, pitchvalue_prob, self.tonic_config['cqt_stride'])
+                    if cache is not None:
+                        cache.save(cache_key, self.get_hist_cqt_name(), hist_cqt)
+                pred_tonic = self.predict_tonic_from_hist(hist_cqt)[0]
+                logger.debug('pred_tonic %s, argmax %s', pred_tonic, np.argmax(pred_tonic))
+                tonic_12, tonic = self.get_tonic_from_pred(pred_tonic)
+            else:
+                tonic_12, tonic = self.get_tonic_from_name(tonic)
+
+            if cache is not None:
+                full_spd_dist = cache.load(cache_key, 'full_spd_dist_{}'.format(tonic))
+                dist_hist = cache.load(cache_key, 'dist_hist_{}'.format(tonic))
+            if cache is None or full_spd_dist is None or dist_hist is None:
+                with instrumentation.span('spd'):
+                    full_spd_dist, dist_hist = self.get_spd_cache(crepe, pitchvalue_prob, tonic)
+                if cache is not None:
+                    cache.save(cache_key, 'full_spd_dist_{}'.format(tonic), full_spd_dist)
+                    cache.save(cache_key, 'dist_hist_{}'.format(tonic), dist_hist)
+            pred_proba = self.predict_raga_proba([(full_spd_dist, dist_hist)])
+            pred_raga = self.get_raga_from_proba(pred_proba[0])
+            return tonic_12, pred_raga
+
+    def get_hist_cqt_name(self):
+        # FeatureCache entry of the tonic histogram, it depends on the CQT stride
+        return 'hist_cqt_{}'.format(self.tonic_config['cqt_stride'])
+
+    def predict_batch(self, crepe, audios, pitchvalue_probs, tonics=None):
+        """
+        Predict the tonic and raga of many clips at once
 
-            print('pred_tonic', pred_tonic)
-            print('argmax pred_tonic', np.argmax(pred_tonic))
+        Parameters
+        ----------
+        audios : list of np.ndarray or None
+            The audio of every clip, only used for clips whose tonic is predicted
+        pitchvalue_probs : list of np.ndarray [shape=(T, 60)]
+            The output of CRePE.predict_pitches for every clip
+        tonics : list of str or None
+            Known tonic of every clip, None entries (or tonics=None) are predicted
 
-            pred_12 = np.sum(np.reshape(pred_tonic, [12, 5]), 1)
-            tonic_12 = standard_tonic[np.argmax(pred_12)]
-            tonic = np.argmax(pred_tonic)
-            # tonic = tonic-3
+        Returns
+        -------
+        tonic_12s, pred_ragas : lists in input order
+        """
+        if tonics is None:
+            tonics = [None] * len(pitchvalue_probs)
 
-            # tonic = 20
-        else:
-            tonic_12 = standard_tonic.index(tonic)
-            tonic = tonic_12*5
-            tonic = tonic+3  # Ugly hack to fix some tonic issue
+        tonic_12s = []
+        spd_caches = []
+        tonics_idx = [None if tonic is None else self.get_tonic_from_name(tonic) for tonic in tonics]
+
+        unknown = [i for i, t in enumerate(tonics_idx) if t is None]
+        if unknown:
+            pred_tonics = self.predict_tonic_batch([audios[i] for i in unknown],
+                                                   [pitchvalue_probs[i] for i in unknown])
+            for i, pred in zip(unknown, pred_tonics):
+                tonics_idx[i] = pred
 
-        # tonic = 20
+        for pitchvalue_prob, (tonic_12, tonic) in zip(pitchvalue_probs, tonics_idx):
+            tonic_12s.append(tonic_12)
+            spd_caches.append(self.get_spd_cache(crepe, pitchvalue_prob, tonic))
+
+        pred_proba = self.predict_raga_proba(spd_caches)
+        pred_ragas = [self.get_raga_from_proba(p) for p in pred_proba]
+        return tonic_12s, pred_ragas
+
+    def predict_tonic(self, audio, pitchvalue_prob):
+        return self.predict_tonic_batch([audio], [pitchvalue_prob])[0]
+
+    def predict_tonic_batch(self, audios, pitchvalue_probs):
+        """
+        Tonic of many clips in one forward pass of the batched tonic model
+
+        Returns a list of (tonic_12, tonic) in input order
+        """
+        hist_cqts = [data_utils.get_hist_cqt(audio, pitchvalue_prob, self.tonic_config['cqt_stride'])
+                     for audio, pitchvalue_prob in zip(audios, pitchvalue_probs)]
+        pred_tonics = self.predict_tonic_from_hist(np.concatenate(hist_cqts, 0))
+        return [self.get_tonic_from_pred(pred_tonic) for pred_tonic in pred_tonics]
+
+    def predict_tonic_from_hist(self, hist_cqts):
+        """
+        [N, 60, 4] hist_cqt batch to [N, 60] tonic activations
+        """
+        graph_tonic, sess_tonic, tonic_model = self.get_tonic_model()
+        with instrumentation.span('tonic_model'), sess_tonic.as_default():
+            with graph_tonic.as_default():
+                return tonic_model.predict(hist_cqts, batch_size=self.tonic_config['batch_size'])
+
+    def get_tonic_from_pred(self, pred_tonic):
+        pred_12 = np.sum(np.reshape(pred_tonic, [12, 5]), 1)
+        tonic_12 = standard_tonic[np.argmax(pred_12)]
+        tonic = np.argmax(pred_tonic)
+        return tonic_12, tonic
+
+    def get_tonic_from_name(self, tonic):
+        tonic_12 = standard_tonic.index(tonic)
+        tonic = tonic_12*5
+        tonic = tonic+3  # Ugly hack to fix some tonic issue
+        return tonic_12, tonic
+
+    def get_spd_cache(self, crepe, pitchvalue_prob, tonic):
         pitchvalue_prob = crepe.stretch(pitchvalue_prob)
         tonic = tonic*2
-        print('tonic', tonic)
         pitchvalue_prob = np.roll(pitchvalue_prob, -tonic, axis=1)
+        return raga_feature.generate_full_spd_cache(pitchvalue_prob)
 
-        pred_proba = raga_feature.get_raga_feat_and_predict(self.knn_models, pitchvalue_prob, len(self.raga_list))
+    def get_raga_from_proba(self, pred_proba):
         pred_proba = pred_proba.T  # (n_labels, 25)
 
         models_weights = np.expand_dims(self.models_weights, 1)
         y_pred = np.matmul(pred_proba, models_weights)[:,0]
         y_pred = np.argmax(y_pred, 0)
-        pred_raga = self.raga_list[y_pred]
-        return tonic_12, pred_raga
+        return self.raga_list[y_pred]
 
     def get_raga_list(self, raga_config, tradition):
         raga_list = pd.read_csv(raga_config['{}_targets'.format(tradition)], header=None)
@@ -368,17 +831,7 @@ class SPD_Model:
 
 
     def mp3_to_wav(self, mp3_path):
-
-        a = AudioSegment.from_mp3(mp3_path)
-        y = np.array(a.get_array_of_samples())
-
-        if a.channels == 2:
-            y = y.reshape((-1, 2))
-            y = y.mean(1)
-        y = np.float32(y) / 2 ** 15
-
-        y = resample(y, a.frame_rate, 16000)
-        return y
+        return data_utils.load_audio(mp3_path)
 
 
     def __data_generation_pitch(self, path, slice_ind, model_srate, step_size, cuttoff):
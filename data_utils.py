@@ -1,9 +1,17 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
 import numpy as np
+from scipy.io import wavfile
+from scipy.signal import resample_poly, get_window
 from numpy.lib.stride_tricks import as_strided
 import librosa
 import librosa.display
 import math
 import raga_feature
+import instrumentation
 from pydub import AudioSegment
 from resampy import resample
 
@@ -20,6 +28,50 @@ def audio_2_frames(audio, config):
 
     return frames
 
+def audio_2_frame_chunks(audio, config, chunk_frames=4096):
+    """
+    Generator version of audio_2_frames, yields the normalized frames chunk_frames at a time
+
+    Frames are strided views into audio until their chunk is copied, so peak memory
+    is bounded by the chunk size instead of the recording length
+    """
+    hop_length = int(16000 * config['hop_size'])
+    n_frames = 1 + int((len(audio) - 1024) / hop_length)
+    audio = np.ascontiguousarray(audio)
+    dtype = audio.dtype if np.issubdtype(audio.dtype, np.floating) else np.float32
+    frames_view = as_strided(audio, shape=(n_frames, 1024),
+                             strides=(hop_length * audio.itemsize, audio.itemsize))
+    for i in range(0, n_frames, chunk_frames):
+        frames = frames_view[i:i + chunk_frames].astype(dtype)
+        frames -= np.mean(frames, axis=1)[:, np.newaxis]
+        frames /= (np.std(frames, axis=1)[:, np.newaxis] + 1e-5)
+        yield frames
+
+def get_voiced_mask(audio, config, chunk_frames=4096):
+    """
+    Cheap voice activity gate on the same 1024 sample frames as audio_2_frames
+
+    A frame is kept when its RMS energy is within config['vad_energy_db'] dB of the
+    loudest frame and its spectral flatness is below config['vad_flatness'], silence
+    and noise-like frames (applause, hiss) are dropped before the pitch model
+    """
+    hop_length = int(16000 * config['hop_size'])
+    n_frames = 1 + int((len(audio) - 1024) / hop_length)
+    audio = np.ascontiguousarray(audio)
+    frames = as_strided(audio, shape=(n_frames, 1024),
+                        strides=(hop_length * audio.itemsize, audio.itemsize))
+    window = np.hanning(1024)
+    rms = np.zeros(n_frames)
+    flatness = np.zeros(n_frames)
+    for i in range(0, n_frames, chunk_frames):
+        chunk = frames[i:i + chunk_frames].astype(np.float64)
+        chunk -= np.mean(chunk, axis=1)[:, np.newaxis]
+        rms[i:i + chunk_frames] = np.sqrt(np.mean(chunk ** 2, axis=1))
+        power = np.abs(np.fft.rfft(chunk * window, axis=1)) ** 2 + 1e-10
+        flatness[i:i + chunk_frames] = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+    energy_db = 20 * np.log10((rms + 1e-10) / (np.max(rms) + 1e-10))
+    return (energy_db > config['vad_energy_db']) & (flatness < config['vad_flatness'])
+
 def to_local_average_cents(salience, center=None):
     """
     find the weighted average cents near the argmax bin
@@ -44,8 +96,15 @@ def to_local_average_cents(salience, center=None):
         #     salience * to_local_average_cents.cents_mapping)
         # return product_sum
     if salience.ndim == 2:
-        return np.array([to_local_average_cents(salience[i, :]) for i in
-                         range(salience.shape[0])])
+        # the 9 bins around the argmax of every row, bins past the edges are masked out
+        center = np.argmax(salience, axis=1)
+        idx = center[:, np.newaxis] + np.arange(-4, 5)
+        valid = (idx >= 0) & (idx < salience.shape[1])
+        idx = np.clip(idx, 0, salience.shape[1] - 1)
+        salience = np.where(valid, np.take_along_axis(salience, idx, axis=1), 0)
+        product_sum = np.sum(salience * to_local_average_cents.cents_mapping[idx], axis=1)
+        weight_sum = np.sum(salience, axis=1)
+        return product_sum / weight_sum
 
     raise Exception("label should be either 1d or 2d ndarray")
 
@@ -67,19 +126,115 @@ def get_cqt(audio, sr=16000):
     c_cqt = np.expand_dims(c_cqt,0)
     return c_cqt
 
-def get_hist_cqt(audio, pitches):
-    pitches = pitches
-    cqt = get_cqt(audio)[0]
-    pitches_mean = np.mean(pitches,0)
-    pitches_std = np.std(pitches, 0)
-    cqt_mean = np.mean(cqt, 0)
-    cqt_std = np.std(cqt, 0)
-    cqt_mean = np.roll(cqt_mean, 3, axis=-1)
-    cqt_std = np.roll(cqt_std, 3, axis=-1)
+_cqt_kernels = {}
+
+def get_cqt_kernel(sr=16000, fmin=32.70319566257483, bins_per_octave=60, n_octaves=7):
+    """
+    FFT-domain CQT filters of the top octave, built once per process
+
+    Every lower octave reuses the same filters on the signal downsampled by two per octave,
+    filters are L1 normalized and scaled by sqrt(length) as librosa.cqt does
+    """
+    key = (sr, fmin, bins_per_octave, n_octaves)
+    if key not in _cqt_kernels:
+        freqs = fmin * 2.0 ** ((n_octaves - 1) + np.arange(bins_per_octave) / bins_per_octave)
+        Q = 1.0 / (2 ** (1.0 / bins_per_octave) - 1)
+        lengths = Q * sr / freqs
+        n_fft = int(2 ** np.ceil(np.log2(np.max(lengths))))
+        kernel = np.zeros([bins_per_octave, n_fft // 2 + 1], dtype=np.complex128)
+        for k in range(bins_per_octave):
+            t = np.arange(-lengths[k] // 2, lengths[k] // 2)
+            sig = np.exp(2j * np.pi * freqs[k] * t / sr) * get_window('hann', len(t))
+            sig /= np.sum(np.abs(sig))
+            basis = np.zeros(n_fft, dtype=np.complex128)
+            start = (n_fft - len(t)) // 2
+            basis[start:start + len(t)] = sig
+            kernel[k] = np.fft.fft(basis)[:n_fft // 2 + 1] * np.sqrt(lengths[k])
+        _cqt_kernels[key] = kernel
+    return _cqt_kernels[key]
+
+def iter_cqt_blocks(audio, sr=16000, hop_length=512, stride=1, n_octaves=7, block_frames=1024):
+    """
+    [60 * n_octaves, block_frames] CQT magnitudes of every stride-th frame, block by block
+
+    Uses the cached kernel of get_cqt_kernel on one decimated copy of the signal per octave
+    """
+    kernel = get_cqt_kernel(sr, librosa.note_to_hz('C1'), 60, n_octaves)
+    n_fft = 2 * (kernel.shape[1] - 1)
+    frame_idx = np.arange(0, 1 + len(audio) // hop_length, stride)
+    y = np.asarray(audio, dtype=np.float64)
+    y_pads = []
+    for i in range(n_octaves):
+        if i > 0:
+            y = resample_poly(y, 1, 2)
+        y_pads.append(np.pad(y, n_fft // 2, mode='wrap'))
+    for b in range(0, len(frame_idx), block_frames):
+        block_idx = frame_idx[b:b + block_frames]
+        C = np.zeros([60 * n_octaves, len(block_idx)], dtype=np.float32)
+        for i, y_pad in enumerate(y_pads):
+            starts = block_idx * (hop_length // 2 ** i)
+            idx = np.minimum(starts[:, np.newaxis] + np.arange(n_fft), len(y_pad) - 1)
+            X = np.fft.rfft(y_pad[idx], axis=1)
+            octave = n_octaves - 1 - i
+            C[octave * 60:(octave + 1) * 60] = np.abs(np.matmul(kernel, X.T)) * np.sqrt(2 ** i)
+        yield C
 
-    hist_cqt = np.stack([stadardize(pitches_mean), stadardize(pitches_std), stadardize(cqt_mean), stadardize(cqt_std)],-1)
-    hist_cqt = np.expand_dims(hist_cqt,0)
-    return hist_cqt
+def iter_cqt_db_blocks(audio, sr=16000, hop_length=512, stride=1, n_octaves=7, block_frames=1024, top_db=80.0):
+    """
+    Folded [block_frames, 60] dB blocks, the same rows as get_cqt
+
+    amplitude_to_db(ref=np.max) needs the loudest bin of the whole clip, so a first pass over
+    the blocks only keeps the running maximum and a second pass converts and folds every block
+    """
+    ref = 0.0
+    for C in iter_cqt_blocks(audio, sr, hop_length, stride, n_octaves, block_frames):
+        ref = max(ref, np.max(C))
+    for C in iter_cqt_blocks(audio, sr, hop_length, stride, n_octaves, block_frames):
+        # relative to the global maximum the loudest bin is 0 dB, so top_db clips at -top_db
+        c_db = np.maximum(librosa.amplitude_to_db(C, ref=ref, top_db=None), -top_db)
+        yield np.transpose(np.mean(np.reshape(c_db, [n_octaves, 60, -1]), axis=0))
+
+def get_cqt_fast(audio, sr=16000, hop_length=512, stride=1, n_octaves=7, block_frames=1024):
+    """
+    Same folded [1, T, 60] output as get_cqt using the cached kernel of get_cqt_kernel
+
+    Only every stride-th CQT frame is computed and the [420, T] magnitudes are never held
+    at once, only block_frames of them (see iter_cqt_db_blocks)
+    """
+    c_cqt = np.concatenate(list(iter_cqt_db_blocks(audio, sr, hop_length, stride, n_octaves, block_frames)))
+    c_cqt = np.expand_dims(c_cqt,0)
+    return c_cqt
+
+def get_cqt_stats(audio, sr=16000, hop_length=512, stride=1, n_octaves=7, block_frames=1024):
+    """
+    Mean and std over time of get_cqt_fast without keeping its rows, blocks are merged in float64
+    """
+    n = 0
+    mean = np.zeros(60)
+    m2 = np.zeros(60)
+    for c_db in iter_cqt_db_blocks(audio, sr, hop_length, stride, n_octaves, block_frames):
+        c_db = np.asarray(c_db, dtype=np.float64)
+        n_b = len(c_db)
+        mean_b = np.mean(c_db, 0)
+        m2_b = np.sum((c_db - mean_b) ** 2, 0)
+        delta = mean_b - mean
+        mean = mean + delta * n_b / (n + n_b)
+        m2 = m2 + m2_b + delta ** 2 * n * n_b / (n + n_b)
+        n += n_b
+    return mean, np.sqrt(m2 / n)
+
+def get_hist_cqt(audio, pitches, cqt_stride=1):
+    with instrumentation.span('hist_cqt'):
+        with instrumentation.span('cqt'):
+            cqt_mean, cqt_std = get_cqt_stats(audio, stride=cqt_stride)
+        pitches_mean = np.mean(pitches,0)
+        pitches_std = np.std(pitches, 0)
+        cqt_mean = np.roll(cqt_mean, 3, axis=-1)
+        cqt_std = np.roll(cqt_std, 3, axis=-1)
+
+        hist_cqt = np.stack([stadardize(pitches_mean), stadardize(pitches_std), stadardize(cqt_mean), stadardize(cqt_std)],-1)
+        hist_cqt = np.expand_dims(hist_cqt,0)
+        return hist_cqt
 
 def get_raga_feat(pitches):
     return raga_feature.get_raga_feat(pitches)
@@ -106,6 +261,136 @@ def mp3_to_wav(mp3_path):
     return y
 
 
+def iter_wav_blocks(file_path, block_size=16000 * 30, target_sr=16000):
+    """
+    Memory-map a WAV file and yield mono float32 blocks resampled to target_sr
+
+    Each block is resampled with a polyphase filter together with enough neighbouring
+    input samples to cover the filter, and block boundaries fall on multiples of the
+    decimation factor, so the concatenated blocks equal resample_poly on the whole file
+    """
+    sr, audio = wavfile.read(file_path, mmap=True)
+    g = math.gcd(sr, target_sr)
+    up, down = target_sr // g, sr // g
+    # resample_poly's default filter reaches 10 * max(up, down) upsampled samples to each side
+    context = 0
+    if up != down:
+        context = down * int(math.ceil((10.0 * max(up, down) / up + 1) / down))
+    block_size = max(down, block_size // down * down)
+    n = len(audio)
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        lo = max(0, start - context)
+        hi = min(n, end + context)
+        x = np.asarray(audio[lo:hi], dtype=np.float32)
+        if len(x.shape) == 2:
+            x = x.mean(1)
+        if up == down:
+            yield x
+            continue
+        y = resample_poly(x, up, down)
+        offset = (start - lo) * up // down
+        n_out = int(math.ceil((end - start) * up / down))
+        yield y[offset:offset + n_out].astype(np.float32)
+
 
+def iter_mp3_blocks(mp3_path, block_size=16000 * 30, queue_blocks=4):
+    """
+    Decode an MP3 with an ffmpeg subprocess into mono 16 kHz float32 blocks
+
+    A reader thread keeps up to queue_blocks decoded blocks ahead of the consumer,
+    so decoding overlaps with pitch inference. Falls back to the full-file pydub
+    decode of mp3_to_wav when ffmpeg is not installed.
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        yield mp3_to_wav(mp3_path)
+        return
 
+    proc = subprocess.Popen([ffmpeg, '-nostdin', '-v', 'error', '-i', mp3_path,
+                             '-f', 'f32le', '-ac', '1', '-ar', '16000', '-'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    blocks = queue.Queue(maxsize=queue_blocks)
+    stderr = []
 
+    def read_stderr():
+        # drained all along, a damaged file can fill the pipe with errors and stall ffmpeg
+        # the last 64 KB are kept for the error message
+        size = 0
+        for data in iter(lambda: proc.stderr.read(4096), b''):
+            stderr.append(data)
+            size += len(data)
+            while size > 1 << 16 and len(stderr) > 1:
+                size -= len(stderr.pop(0))
+
+    def read_blocks():
+        try:
+            while True:
+                data = proc.stdout.read(block_size * 4)
+                if not data:
+                    break
+                blocks.put(np.frombuffer(data[:len(data) // 4 * 4], dtype=np.float32))
+        finally:
+            blocks.put(None)
+
+    reader = threading.Thread(target=read_blocks, daemon=True)
+    reader.start()
+    stderr_reader = threading.Thread(target=read_stderr, daemon=True)
+    stderr_reader.start()
+    finished = False
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            yield block
+        finished = True
+    finally:
+        if not finished:
+            proc.kill()
+            # unblock the reader if it is waiting on a full queue
+            while reader.is_alive():
+                try:
+                    blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        reader.join()
+        proc.stdout.close()
+        proc.wait()
+        stderr_reader.join()
+        proc.stderr.close()
+    if proc.returncode != 0:
+        raise IOError('ffmpeg could not decode {}: {}'.format(mp3_path, b''.join(stderr).decode(errors='replace').strip()))
+
+
+def iter_audio_blocks(file_path, block_size=16000 * 30):
+    if os.path.splitext(file_path)[1].lower() == '.mp3':
+        for block in iter_mp3_blocks(file_path, block_size):
+            yield block
+    else:
+        for block in iter_wav_blocks(file_path, block_size):
+            yield block
+
+
+def blocks_2_frame_chunks(blocks, config, chunk_frames=4096):
+    """
+    audio_2_frame_chunks over a stream of audio blocks, the frames are the same as framing the
+    concatenated blocks but only one block plus the unfinished last frame is held in memory
+    """
+    hop_length = int(16000 * config['hop_size'])
+    buffer = np.zeros(0, dtype=np.float32)
+    for block in blocks:
+        buffer = np.concatenate([buffer, block])
+        if len(buffer) < 1024:
+            continue
+        n_frames = 1 + int((len(buffer) - 1024) / hop_length)
+        for frames in audio_2_frame_chunks(buffer[:(n_frames - 1) * hop_length + 1024], config, chunk_frames):
+            yield frames
+        buffer = buffer[n_frames * hop_length:]
+
+
+def load_audio(file_path):
+    """
+    Mono float32 audio at 16 kHz, WAV files are memory-mapped and resampled block by block
+    """
+    return np.concatenate(list(iter_audio_blocks(file_path)))
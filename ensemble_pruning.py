@@ -0,0 +1,202 @@
+import json
+import time
+import numpy as np
+import data_utils
+import raga_feature
+
+WDS = list(range(0, 250, 10))
+
+
+def read_labelled_manifest(manifest):
+    """
+    One 'path<TAB>raga[<TAB>tonic]' per line, clips without a tonic get it predicted
+    """
+    rows = []
+    with open(manifest) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                cols = line.split('\t')
+                rows.append((cols[0], cols[1], cols[2] if len(cols) > 2 and cols[2] else None))
+    return rows
+
+
+def get_spd_caches(crepe, spd_model, rows):
+    spd_caches = []
+    labels = []
+    for file_path, raga, tonic in rows:
+        audio = data_utils.load_audio(file_path)
+        pitches = crepe.predict_pitches(audio)
+        if tonic is None:
+            _, tonic = spd_model.predict_tonic(audio, pitches)
+        else:
+            _, tonic = spd_model.get_tonic_from_name(tonic)
+        spd_caches.append(spd_model.get_spd_cache(crepe, pitches, tonic))
+        labels.append(spd_model.raga_list.index(raga))
+    return spd_caches, np.array(labels)
+
+
+def measure_models(spd_model, spd_caches, n_repeats=3):
+    """
+    pred_proba [N, 25, n_labels] of every wd model and its latency in seconds per clip
+
+    Clips are scored one at a time like a single file request, the latency of a model
+    is the fastest of n_repeats passes so it is not inflated by loading or noise
+    """
+    n_labels = len(spd_model.raga_list)
+    pred_proba = np.zeros([len(spd_caches), 25, n_labels])
+    latency = np.zeros(25)
+    for wd in WDS:
+        spd_model.knn_models[wd]
+        times = []
+        for _ in range(n_repeats):
+            t0 = time.time()
+            for i, spd_cache in enumerate(spd_caches):
+                p = raga_feature.get_raga_feat_and_predict_batch(spd_model.knn_models, [spd_cache], n_labels, [wd])
+                pred_proba[i, wd // 10] = p[0, wd // 10]
+            times.append(time.time() - t0)
+        latency[wd // 10] = min(times) / len(spd_caches)
+    return pred_proba, latency
+
+
+def get_accuracy(pred_proba, labels, weights):
+    # the combination of SPD_Model.get_raga_from_proba
+    y_pred = np.argmax(np.einsum('nml,m->nl', pred_proba, weights), 1)
+    return float(np.mean(y_pred == labels))
+
+
+def fit_weights(pred_proba, labels, wds, ridge=1e-2):
+    """
+    Ridge regression of the one-hot labels on the probabilities of the models in wds,
+    the models outside wds get weight 0
+    """
+    idx = [wd // 10 for wd in wds]
+    A = np.transpose(pred_proba[:, idx, :], [0, 2, 1]).reshape(-1, len(idx))
+    y = np.eye(pred_proba.shape[2])[labels].reshape(-1)
+    weights = np.zeros(25)
+    weights[idx] = np.linalg.solve(np.matmul(A.T, A) + ridge * np.eye(len(idx)), np.matmul(A.T, y))
+    return weights
+
+
+def split_folds(n, n_folds, seed=0):
+    return np.array_split(np.random.RandomState(seed).permutation(n), n_folds)
+
+
+def get_cv_accuracy(pred_proba, labels, wds, folds):
+    """
+    Accuracy of the ensemble of wds on every fold with weights fitted on the other folds
+    """
+    correct = 0
+    for fold in folds:
+        train = np.setdiff1d(np.arange(len(labels)), fold)
+        weights = fit_weights(pred_proba[train], labels[train], wds)
+        correct += get_accuracy(pred_proba[fold], labels[fold], weights) * len(fold)
+    return correct / len(labels)
+
+
+def get_marginal_contributions(pred_proba, labels, weights):
+    """
+    Accuracy lost when each model is dropped from the ensemble with its current weights
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    accuracy = get_accuracy(pred_proba, labels, weights)
+    contributions = np.zeros(25)
+    for m in range(25):
+        weights_m = weights.copy()
+        weights_m[m] = 0
+        contributions[m] = accuracy - get_accuracy(pred_proba, labels, weights_m)
+    return contributions
+
+
+def prune_ensemble(pred_proba, labels, latency, budget, base_weights, n_folds=5, seed=0):
+    """
+    Greedy backward elimination until the summed latency of the kept models fits the budget
+
+    Accuracy is the n_folds cross-validated accuracy of get_cv_accuracy. When dropping a single
+    model can bring the ensemble under budget, the most accurate such removal is taken. Otherwise
+    every step drops the model that loses the least accuracy per second of latency saved, among
+    removals that lose no accuracy the slowest model goes first. The weights of the kept models are then fitted on all the given clips.
+    Returns the kept wds, their 25 weights and the steps.
+    """
+    folds = split_folds(len(labels), n_folds, seed)
+    wds = list(WDS)
+    weights = np.asarray(base_weights, dtype=np.float64)
+    history = []
+    while len(wds) > 1 and np.sum(latency[[wd // 10 for wd in wds]]) > budget:
+        curr_latency = np.sum(latency[[wd // 10 for wd in wds]])
+        curr_accuracy = get_cv_accuracy(pred_proba, labels, wds, folds)
+        best = None
+        for wd in wds:
+            cand_wds = [w for w in wds if w != wd]
+            accuracy = get_cv_accuracy(pred_proba, labels, cand_wds, folds)
+            saved = latency[wd // 10]
+            fits = curr_latency - saved <= budget
+            cost = max(curr_accuracy - accuracy, 0) / max(saved, 1e-9)
+            # smallest key wins
+            key = (not fits, -accuracy if fits else cost, -saved, -accuracy)
+            if best is None or key < best[0]:
+                best = (key, wd, cand_wds, accuracy)
+        _, removed, wds, accuracy = best
+        weights = fit_weights(pred_proba, labels, wds)
+        history.append({'removed': removed, 'cv_accuracy': accuracy,
+                        'latency_ms': 1000 * float(np.sum(latency[[wd // 10 for wd in wds]]))})
+        print('dropped wd={}: {} models, cv accuracy {:.3f}, latency {:.1f} ms'.format(
+            removed, len(wds), accuracy, history[-1]['latency_ms']))
+    return wds, weights, history
+
+
+def run_pruning(crepe, spd_model, manifest, budget_ms, name, test_fraction=0.3, n_folds=5, seed=0):
+    """
+    Measure the 25 models on a labelled manifest, prune them to budget_ms per clip and save
+    the result as the ensemble profile name of the tradition (see SPD_Model.set_ensemble_profile)
+
+    A test_fraction of the clips is held out, the subset and its weights are chosen on the
+    rest with n_folds cross-validation, and every reported accuracy is measured on the held
+    out clips: the pruned ensemble, the full ensemble with its shipped weights and the full
+    ensemble with weights re-fitted like the pruned one.
+    """
+    rows = read_labelled_manifest(manifest)
+    spd_caches, labels = get_spd_caches(crepe, spd_model, rows)
+    pred_proba, latency = measure_models(spd_model, spd_caches)
+
+    idx = np.random.RandomState(seed).permutation(len(labels))
+    n_test = int(round(test_fraction * len(labels)))
+    test, train = idx[:n_test], idx[n_test:]
+    if n_test == 0 or len(train) < n_folds:
+        raise ValueError('{} labelled clips are too few for a {} test split and {} folds'.format(
+            len(labels), test_fraction, n_folds))
+
+    full_weights = np.asarray(spd_model.models_weights, dtype=np.float64)
+    contributions = get_marginal_contributions(pred_proba[test], labels[test], full_weights)
+    for wd in WDS:
+        print('wd={}: {:.2f} ms, weight {:.4f}, held-out marginal accuracy {:+.3f}'.format(
+            wd, 1000 * latency[wd // 10], full_weights[wd // 10], contributions[wd // 10]))
+
+    wds, weights, history = prune_ensemble(pred_proba[train], labels[train], latency, budget_ms / 1000,
+                                           full_weights, n_folds, seed)
+    accuracy = get_accuracy(pred_proba[test], labels[test], weights)
+    full_accuracy = get_accuracy(pred_proba[test], labels[test], full_weights)
+    full_refit_accuracy = get_accuracy(pred_proba[test], labels[test],
+                                       fit_weights(pred_proba[train], labels[train], WDS))
+    profile = {'wds': wds,
+               'weights': [float(w) for w in weights],
+               'accuracy': accuracy,
+               'latency_ms': 1000 * float(np.sum(latency[[wd // 10 for wd in wds]])),
+               'full_accuracy': full_accuracy,
+               'full_refit_accuracy': full_refit_accuracy,
+               'full_latency_ms': 1000 * float(np.sum(latency)),
+               'budget_ms': budget_ms,
+               'n_clips': len(labels),
+               'n_train': len(train),
+               'n_test': n_test,
+               'n_folds': n_folds,
+               'models': [{'wd': wd, 'latency_ms': 1000 * float(latency[wd // 10]),
+                           'marginal_accuracy': float(contributions[wd // 10])} for wd in WDS],
+               'history': history}
+    path = spd_model.get_ensemble_profile_path(name)
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2)
+    print('wrote {}: {} models, held-out accuracy {:.3f} (full {:.3f}, full re-fitted {:.3f} on {} clips), '
+          'latency {:.1f} ms (full {:.1f} ms)'.format(path, len(wds), accuracy, full_accuracy, full_refit_accuracy,
+                                                      n_test, profile['latency_ms'], profile['full_latency_ms']))
+    return profile
@@ -0,0 +1,93 @@
+import os
+import hashlib
+import numpy as np
+import instrumentation
+
+
+class FeatureCache:
+    """
+    Content-addressed on-disk cache of pitch activations and SPD features
+
+    Entries live in cache_dir/<key>/<name>.npy where the key hashes the audio
+    content together with the pitch config, the pitch backend and the model
+    artifact the pitches come from (CRePE.model_path), so a changed or different
+    model never serves stale features. The least recently used files
+    are evicted once the cache grows over max_bytes.
+    """
+
+    def __init__(self, cache_dir, pitch_config, weights_path='model/model-full.h5', max_bytes=2 * 1024 ** 3,
+                 backend=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+        model_hash = hashlib.sha1()
+        model_hash.update(repr(sorted(pitch_config.items())).encode())
+        model_hash.update('backend:{}'.format(backend).encode())
+        if os.path.exists(weights_path):
+            stat = os.stat(weights_path)
+            model_hash.update('{}:{}:{}'.format(os.path.abspath(weights_path), stat.st_size, stat.st_mtime).encode())
+        self.model_key = model_hash.hexdigest()
+
+    def get_key_for_file(self, file_path, block_size=1 << 20):
+        h = hashlib.sha1(self.model_key.encode())
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def get_key_for_audio(self, audio):
+        audio = np.ascontiguousarray(audio)
+        h = hashlib.sha1(self.model_key.encode())
+        h.update(str(audio.dtype).encode())
+        h.update(audio.tobytes())
+        return h.hexdigest()
+
+    def get_path(self, key, name):
+        return os.path.join(self.cache_dir, key, '{}.npy'.format(name))
+
+    def load(self, key, name):
+        path = self.get_path(key, name)
+        try:
+            arr = np.load(path, allow_pickle=False)
+        except (IOError, ValueError):
+            self.misses += 1
+            instrumentation.count('cache_misses')
+            return None
+        os.utime(path, None)
+        self.hits += 1
+        instrumentation.count('cache_hits')
+        return arr
+
+    def save(self, key, name, arr):
+        path = self.get_path(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, arr)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,178 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Conv1D, BatchNormalization, Dense
+
+
+def get_bn_affine(bn):
+    """
+    Inference BatchNormalization as a per channel scale and shift
+    """
+    weights = dict(zip([w.name.split('/')[-1].split(':')[0] for w in bn.weights], bn.get_weights()))
+    mean = weights['moving_mean']
+    scale = weights.get('gamma', np.ones_like(mean)) / np.sqrt(weights['moving_variance'] + bn.epsilon)
+    shift = weights.get('beta', np.zeros_like(mean)) - mean * scale
+    return scale.astype(np.float32), shift.astype(np.float32)
+
+
+def get_layers(model, layer_type):
+    return [layer for layer in model.layers if isinstance(layer, layer_type)]
+
+
+def build_pitch_graph(pitch_model):
+    """
+    Constant-folded inference graph of CRePE.build_model, x_input [N, 1024] -> pitch [N, 360]
+
+    Dropout is dropped and every BatchNormalization becomes one multiply-add, it follows the
+    ReLU so it cannot be folded into the convolution. Must run in the session of pitch_model.
+    """
+    convs = [pitch_model.get_layer('conv%d' % l) for l in range(1, 7)]
+    bns = [get_bn_affine(pitch_model.get_layer('conv%d-BN' % l)) for l in range(1, 7)]
+    classifier = pitch_model.get_layer('classifier')
+    conv_weights = [conv.get_weights() for conv in convs]
+    dense_w, dense_b = classifier.get_weights()
+
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.compat.v1.placeholder(tf.float32, [None, 1024], name='x_input')
+        y = tf.reshape(x, [-1, 1024, 1, 1])
+        for conv, (w, b), (scale, shift) in zip(convs, conv_weights, bns):
+            y = tf.nn.conv2d(y, w, strides=(1,) + tuple(conv.strides) + (1,), padding='SAME')
+            y = tf.nn.relu(tf.nn.bias_add(y, b))
+            y = y * scale + shift
+            y = tf.nn.max_pool2d(y, ksize=(2, 1), strides=(2, 1), padding='VALID')
+        y = tf.transpose(y, [0, 2, 1, 3])
+        y = tf.reshape(y, [-1, dense_w.shape[0]])
+        tf.sigmoid(tf.matmul(y, dense_w) + dense_b, name='pitch')
+    return graph.as_graph_def()
+
+
+def build_tonic_graph(tonic_model, roll_idx, unroll):
+    """
+    Constant-folded inference graph of the 'tonic_batch' model, hist_cqt_input [N, 60, 4] -> tonic [N, 60]
+
+    The rotation set is baked in through roll_idx and unroll (see SPD_Model.get_tonic_unroll).
+    Must run in the session of tonic_model.
+    """
+    conv_weights = [conv.get_weights() for conv in get_layers(tonic_model, Conv1D)]
+    bns = [get_bn_affine(bn) for bn in get_layers(tonic_model, BatchNormalization)]
+    (emb_w, emb_b), (out_w, out_b) = [dense.get_weights() for dense in get_layers(tonic_model, Dense)]
+
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.compat.v1.placeholder(tf.float32, [None, 60, 4], name='hist_cqt_input')
+        y = tf.reshape(tf.gather(x, roll_idx, axis=1), [-1, 60, 4])
+        for i, (scale, shift) in enumerate(bns):
+            for w, b in conv_weights[2 * i:2 * i + 2]:
+                y = tf.nn.relu(tf.nn.bias_add(tf.nn.conv1d(y, w, stride=1, padding='SAME'), b))
+            y = y * scale + shift
+            y = tf.nn.max_pool1d(y, ksize=2, strides=2, padding='VALID')
+        y = tf.reshape(y, [-1, emb_w.shape[0]])
+        y = tf.nn.relu(tf.matmul(y, emb_w) + emb_b)
+        y = tf.sigmoid(tf.matmul(y, out_w) + out_b)
+        y = tf.reshape(y, [-1, len(roll_idx), 60])
+        # einsum puts its name on a scope, the output op is named through identity
+        tf.identity(tf.einsum('nri,rij->nj', y, unroll), name='tonic')
+    return graph.as_graph_def()
+
+
+def save_graph(graph_def, path):
+    with open(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+
+class FrozenModel:
+    """
+    Serves a graph written by save_graph, with the predict interface of the keras models it replaces
+    """
+
+    def __init__(self, path, input_name, output_name, config=None):
+        graph_def = tf.compat.v1.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.sess = tf.compat.v1.Session(graph=self.graph, config=config)
+        self.x = self.graph.get_tensor_by_name(input_name + ':0')
+        self.y = self.graph.get_tensor_by_name(output_name + ':0')
+
+    def predict(self, x, batch_size=32):
+        y = []
+        for i in range(0, len(x), batch_size):
+            y.append(self.sess.run(self.y, {self.x: x[i:i + batch_size]}))
+        return np.concatenate(y)
+
+
+def convert_to_tflite(graph_def, input_name, output_name, quantization='dynamic', representative_data=None):
+    """
+    Post-training quantized TFLite flatbuffer of a graph written by build_pitch_graph
+
+    quantization 'dynamic' stores int8 weights and quantizes activations on the fly,
+    'int8' also quantizes activations with ranges calibrated on representative_data,
+    an iterable of single input rows. Inputs and outputs stay float32 in both modes.
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    with tf.compat.v1.Session(graph=graph) as sess:
+        converter = tf.compat.v1.lite.TFLiteConverter.from_session(
+            sess, [graph.get_tensor_by_name(input_name + ':0')], [graph.get_tensor_by_name(output_name + ':0')])
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == 'int8':
+            def representative_dataset():
+                for x in representative_data:
+                    yield [np.asarray(x, dtype=np.float32)[np.newaxis]]
+            converter.representative_dataset = representative_dataset
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        elif quantization != 'dynamic':
+            raise ValueError('quantization should be either dynamic or int8, got {}'.format(quantization))
+        return converter.convert()
+
+
+def save_tflite(tflite_model, path):
+    with open(path, 'wb') as f:
+        f.write(tflite_model)
+
+
+class TFLiteModel:
+    """
+    TFLite interpreter with the predict interface of the keras models, rows are run batch_size
+    at a time and the last batch is zero padded so the input tensor is only allocated once
+    """
+
+    def __init__(self, path, threads=None, batch_size=32):
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=threads)
+        input_details = self.interpreter.get_input_details()[0]
+        self.input_index = input_details['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.input_shape = list(input_details['shape'][1:])
+        self.batch_size = batch_size
+        self.interpreter.resize_tensor_input(self.input_index, [batch_size] + self.input_shape)
+        self.interpreter.allocate_tensors()
+
+    def predict(self, x, batch_size=None):
+        y = []
+        for i in range(0, len(x), self.batch_size):
+            batch = np.asarray(x[i:i + self.batch_size], dtype=np.float32)
+            n = len(batch)
+            if n < self.batch_size:
+                batch = np.concatenate([batch, np.zeros([self.batch_size - n] + self.input_shape, dtype=np.float32)])
+            self.interpreter.set_tensor(self.input_index, batch)
+            self.interpreter.invoke()
+            y.append(self.interpreter.get_tensor(self.output_index)[:n].copy())
+        return np.concatenate(y)
+
+
+def get_max_diff(model, frozen_model, x, batch_size=32):
+    return float(np.max(np.abs(model.predict(x, batch_size=batch_size) - frozen_model.predict(x, batch_size))))
+
+
+def check_max_diff(name, model, frozen_model, x, tolerance, batch_size=32):
+    """
+    get_max_diff that raises ValueError when the exported model is off by more than tolerance
+    """
+    diff = get_max_diff(model, frozen_model, x, batch_size)
+    print('{} max output difference: {} (tolerance {})'.format(name, diff, tolerance))
+    if not diff <= tolerance:
+        raise ValueError('{} differs from the keras model by {} > {}'.format(name, diff, tolerance))
+    return diff
@@ -0,0 +1,150 @@
+import json
+import time
+import logging
+import threading
+import numpy as np
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+
+    def __enter__(self):
+        stack = self.instruments.get_stack()
+        stack.append(self.name)
+        self.full_name = '/'.join(stack)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.t0
+        self.instruments.get_stack().pop()
+        self.instruments.emit({'type': 'span', 'name': self.full_name, 'value': duration, 'time': time.time()})
+        return False
+
+
+class Instruments:
+    """
+    Named timing spans and counters sent to pluggable sinks
+
+    Disabled by default, span() then returns a shared no-op context manager and count()
+    returns right away, so instrumented code pays one attribute check per call. Nested
+    spans are named by their path, e.g. predict_tonic_raga/knn/wd_120.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def enable(self, *sinks):
+        self.sinks = list(sinks)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.sinks = []
+
+    def get_stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        stack = self.get_stack()
+        full_name = '/'.join(stack + [name]) if stack else name
+        self.emit({'type': 'count', 'name': full_name, 'value': n, 'time': time.time()})
+
+    def emit(self, event):
+        with self.lock:
+            for sink in self.sinks:
+                sink.write(event)
+
+
+class LogSink:
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('instrumentation')
+        self.level = level
+
+    def write(self, event):
+        if event['type'] == 'span':
+            self.logger.log(self.level, '%s %.4fs', event['name'], event['value'])
+        else:
+            self.logger.log(self.level, '%s +%s', event['name'], event['value'])
+
+
+class JSONSink:
+    """
+    One JSON object per event and line
+    """
+
+    def __init__(self, path):
+        self.f = open(path, 'a')
+
+    def write(self, event):
+        self.f.write(json.dumps(event) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class HistogramSink:
+    """
+    Keeps every span duration and counter total in memory, summary() gives the per name statistics
+    """
+
+    def __init__(self):
+        self.spans = {}
+        self.counts = {}
+
+    def write(self, event):
+        if event['type'] == 'span':
+            self.spans.setdefault(event['name'], []).append(event['value'])
+        else:
+            self.counts[event['name']] = self.counts.get(event['name'], 0) + event['value']
+
+    def summary(self):
+        spans = {}
+        for name, values in sorted(self.spans.items()):
+            values = np.asarray(values)
+            spans[name] = {'count': len(values), 'total': float(np.sum(values)), 'mean': float(np.mean(values)),
+                           'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)),
+                           'max': float(np.max(values))}
+        return {'spans': spans, 'counts': dict(sorted(self.counts.items()))}
+
+    def report(self):
+        summary = self.summary()
+        lines = ['{:50s} {:>6s} {:>9s} {:>9s} {:>9s} {:>9s}'.format('span', 'count', 'total', 'mean', 'p95', 'max')]
+        for name, s in summary['spans'].items():
+            lines.append('{:50s} {:6d} {:9.4f} {:9.4f} {:9.4f} {:9.4f}'.format(
+                name, s['count'], s['total'], s['mean'], s['p95'], s['max']))
+        for name, value in summary['counts'].items():
+            lines.append('{:50s} {}'.format(name, value))
+        return '\n'.join(lines)
+
+
+instruments = Instruments()
+span = instruments.span
+count = instruments.count
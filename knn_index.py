@@ -0,0 +1,315 @@
+import os
+import pickle
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def hellinger_transform(X):
+    """
+    Map histograms to the unit sphere, the Bhattacharyya coefficient of two
+    histograms becomes the inner product of their transformed rows
+    """
+    X = np.maximum(np.asarray(X, dtype=np.float64), 0)
+    X_sum = np.sum(X, axis=-1, keepdims=True)
+    return np.sqrt(X / np.maximum(X_sum, 1e-12))
+
+
+class HellingerKNN:
+    """
+    Drop-in replacement of SPDKNN that ranks neighbours with one matrix product
+
+    SPDKNN.bhatta is sqrt(1 - <u1, u2>) with u = sqrt(h / sum(h)), which is
+    ||u1 - u2|| / sqrt(2), so the nearest neighbours under the Bhattacharyya
+    distance are the rows with the largest inner product in the transformed space
+    """
+
+    def __init__(self, k=5, chunk_rows=4096):
+        self.k = k
+        self.chunk_rows = chunk_rows
+        self.U = None
+        self.y = None
+        self.classes = None
+
+    def fit(self, X, y):
+        self.classes, self.y = np.unique(y, return_inverse=True)
+        self.U = hellinger_transform(X)
+        return self
+
+    def get_scores(self, X):
+        # U may be a read-only float16/32 memmap, it is scored chunk_rows training rows at a time
+        U_X = hellinger_transform(X)
+        scores = np.empty([len(U_X), len(self.U)])
+        for i in range(0, len(self.U), self.chunk_rows):
+            U_chunk = np.asarray(self.U[i:i + self.chunk_rows], dtype=np.float64)
+            scores[:, i:i + self.chunk_rows] = np.matmul(U_X, U_chunk.T)
+        return scores
+
+    def kneighbors(self, X, k=None, self_idx=None):
+        # self_idx: training row of every query that is left out, for leave-one-out queries
+        scores = self.get_scores(X)
+        if self_idx is not None:
+            scores[np.arange(len(scores)), self_idx] = -np.inf
+        k = min(k or self.k, scores.shape[1])
+        neigh_idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        return neigh_idx
+
+    def predict(self, X, self_idx=None):
+        neigh_idx = self.kneighbors(X, self_idx=self_idx)
+        neigh_y = self.y[neigh_idx]
+        proba = np.zeros([len(neigh_y), len(self.classes)])
+        for i in range(len(neigh_y)):
+            proba[i] = np.bincount(neigh_y[i], minlength=len(self.classes))
+        return proba / neigh_idx.shape[1]
+
+    def save(self, path):
+        np.savez(path, U=self.U, y=self.y, classes=self.classes, k=self.k)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=False)
+        knn = cls(int(data['k']))
+        knn.U = data['U']
+        knn.y = data['y']
+        knn.classes = data['classes']
+        return knn
+
+    def save_store(self, store_dir, wd, dtype='float32'):
+        """
+        Write the training rows to store_dir/U_{wd}.npy and the labels to store_dir/knn_{wd}.npz
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        np.save(os.path.join(store_dir, 'U_{}.npy'.format(wd)), np.asarray(self.U, dtype=dtype))
+        np.savez(os.path.join(store_dir, 'knn_{}.npz'.format(wd)), y=self.y, classes=self.classes, k=self.k)
+
+    @classmethod
+    def load_store(cls, store_dir, wd, mmap=True):
+        """
+        The training rows are memory-mapped read-only, so every process scoring from the same
+        store shares one copy in the page cache
+        """
+        data = np.load(os.path.join(store_dir, 'knn_{}.npz'.format(wd)), allow_pickle=False)
+        knn = cls(int(data['k']))
+        knn.U = np.load(os.path.join(store_dir, 'U_{}.npy'.format(wd)), mmap_mode='r' if mmap else None)
+        knn.y = data['y']
+        knn.classes = data['classes']
+        return knn
+
+    @classmethod
+    def from_spd_knn(cls, spd_knn):
+        knn = getattr(spd_knn, 'knn', spd_knn)
+        if knn.weights != 'uniform':
+            raise ValueError('only uniform KNN weights can be converted, got {}'.format(knn.weights))
+        hknn = cls(knn.n_neighbors)
+        hknn.U = hellinger_transform(knn._fit_X)
+        hknn.y = np.asarray(knn._y)
+        hknn.classes = np.asarray(knn.classes_)
+        return hknn
+
+
+class ProjectedKNN(HellingerKNN):
+    """
+    HellingerKNN in a reduced space, fitted offline from a full HellingerKNN
+
+    The Hellinger rows are centered and projected on n_components PCA directions (or a
+    gaussian random projection) and neighbours are ranked by euclidean distance there,
+    which on the full unit-norm rows is the same ranking as the inner product. With PCA
+    and n_components >= n_train - 1 the ranking is exact, the query component outside the
+    span of the training rows adds the same distance to every row.
+    """
+
+    def __init__(self, k=5, chunk_rows=4096):
+        super().__init__(k, chunk_rows)
+        self.P = None
+        self.mean = None
+        self.U_norm2 = None
+        self.method = None
+
+    def project(self, X):
+        return np.matmul(hellinger_transform(X) - self.mean, self.P)
+
+    def fit_projection(self, hknn, method='pca', n_components=256, seed=0):
+        U = np.asarray(hknn.U, dtype=np.float64)
+        self.k = hknn.k
+        self.y = hknn.y
+        self.classes = hknn.classes
+        self.method = method
+        self.mean = np.mean(U, axis=0)
+        if method == 'pca':
+            _, _, Vt = np.linalg.svd(U - self.mean, full_matrices=False)
+            self.P = Vt[:n_components].T
+        elif method == 'random':
+            self.P = np.random.RandomState(seed).randn(U.shape[1], n_components) / np.sqrt(n_components)
+        else:
+            raise ValueError('method should be either pca or random, got {}'.format(method))
+        self.P = self.P.astype(np.float32)
+        self.mean = self.mean.astype(np.float32)
+        self.U = np.matmul(U - self.mean, self.P)
+        self.U_norm2 = np.sum(self.U ** 2, axis=1)
+        return self
+
+    def get_scores(self, X):
+        # larger is closer, -||z - u||^2 without the ||z||^2 that is the same for every row
+        return 2 * np.matmul(self.project(X), self.U.T) - self.U_norm2
+
+    def get_nbytes(self):
+        return self.U.nbytes + self.P.nbytes + self.mean.nbytes
+
+    def save(self, path):
+        np.savez(path, U=self.U, y=self.y, classes=self.classes, k=self.k, P=self.P, mean=self.mean,
+                 method=self.method)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=False)
+        knn = cls(int(data['k']))
+        knn.U = data['U']
+        knn.y = data['y']
+        knn.classes = data['classes']
+        knn.P = data['P']
+        knn.mean = data['mean']
+        knn.method = str(data['method'])
+        knn.U_norm2 = np.sum(knn.U ** 2, axis=1)
+        return knn
+
+
+def get_recall(exact_knn, approx_knn, X, self_idx=None):
+    """
+    Mean fraction of the exact k neighbours found by approx_knn, when the queries are training
+    rows their own index (self_idx) is left out of both neighbour lists
+    """
+    k = exact_knn.k
+    neigh_idx = [knn.kneighbors(X, k, self_idx) for knn in [exact_knn, approx_knn]]
+    return float(np.mean([len(set(e) & set(a)) / k for e, a in zip(*neigh_idx)]))
+
+
+def get_knn_path(tradition, wd, ext):
+    return 'data/RagaDataset/{}/model/spd_knn_{}.{}'.format(tradition, wd, ext)
+
+
+def get_store_dir(tradition):
+    return 'data/RagaDataset/{}/model/spd_store'.format(tradition)
+
+
+def load_knn_model(tradition, wd, projected=True):
+    path = get_knn_path(tradition, wd, 'proj.npz')
+    if projected and os.path.exists(path):
+        return ProjectedKNN.load(path)
+    store_dir = get_store_dir(tradition)
+    if os.path.exists(os.path.join(store_dir, 'U_{}.npy'.format(wd))):
+        return HellingerKNN.load_store(store_dir, wd)
+    path = get_knn_path(tradition, wd, 'npz')
+    if os.path.exists(path):
+        return HellingerKNN.load(path)
+    with open(get_knn_path(tradition, wd, 'pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+def get_check_queries(X, n_check, seed=0):
+    """
+    n_check queries that are not training rows, each one the mean of two different random rows of X
+    """
+    rng = np.random.RandomState(seed)
+    idx1 = rng.randint(0, len(X), n_check)
+    idx2 = (idx1 + rng.randint(1, len(X), n_check)) % len(X)
+    return (np.asarray(X[idx1], dtype=np.float64) + np.asarray(X[idx2], dtype=np.float64)) / 2
+
+
+def check_proba_diff(name, knn, ref_knn, X, tolerance):
+    """
+    Raise a ValueError when the predict_proba of knn and ref_knn on X differ by more than tolerance
+    """
+    max_diff = np.max(np.abs(knn.predict(X) - ref_knn.predict(X)))
+    print('{} max predict_proba difference: {}'.format(name, max_diff))
+    if not max_diff <= tolerance:
+        raise ValueError('{} predict_proba differs by {} from the reference, above the tolerance {}'.format(
+            name, max_diff, tolerance))
+    return max_diff
+
+
+def convert_spd_knn_models(tradition, n_check=50, tolerance=1e-6):
+    """
+    Convert the pickled spd_knn_{wd}.pkl models to spd_knn_{wd}.npz indexes
+
+    The pickles hold SPDKNN instances, so this has to run where SPDKNN can be
+    unpickled (main.py --convert_knn). Both models score n_check queries mixed from
+    the training rows and a model whose predict_proba differs by more than tolerance
+    is not saved.
+    """
+    for wd in range(0, 250, 10):
+        with open(get_knn_path(tradition, wd, 'pkl'), 'rb') as f:
+            spd_knn = pickle.load(f)
+        hknn = HellingerKNN.from_spd_knn(spd_knn)
+        if n_check > 0:
+            X_check = get_check_queries(getattr(spd_knn, 'knn', spd_knn)._fit_X, n_check)
+            check_proba_diff('{} wd={}'.format(tradition, wd), hknn, spd_knn, X_check, tolerance)
+        hknn.save(get_knn_path(tradition, wd, 'npz'))
+
+
+def migrate_knn_store(tradition, dtype='float32', n_check=50, tolerance=0.2):
+    """
+    Write the memory-mapped feature store of a tradition from its .npz indexes or, where
+    there is none, its pickled SPDKNN models (so like convert_spd_knn_models this runs from
+    main.py). Both score n_check queries mixed from the training rows, the default tolerance
+    is one neighbour vote of k=5 as float16 rows can swap near-tied neighbours. A store whose
+    predict_proba differs by more is removed again.
+    """
+    store_dir = get_store_dir(tradition)
+    for wd in range(0, 250, 10):
+        path = get_knn_path(tradition, wd, 'npz')
+        if os.path.exists(path):
+            hknn = HellingerKNN.load(path)
+        else:
+            with open(get_knn_path(tradition, wd, 'pkl'), 'rb') as f:
+                hknn = HellingerKNN.from_spd_knn(pickle.load(f))
+        hknn.save_store(store_dir, wd, dtype)
+        if n_check > 0:
+            X_check = get_check_queries(hknn.U, n_check) ** 2
+            try:
+                check_proba_diff('{} wd={}'.format(tradition, wd), HellingerKNN.load_store(store_dir, wd), hknn,
+                                 X_check, tolerance)
+            except ValueError:
+                for name in ['U_{}.npy', 'knn_{}.npz']:
+                    os.remove(os.path.join(store_dir, name.format(wd)))
+                raise
+
+
+def fit_projections(tradition, wds=range(120, 250, 10), method='pca', n_components=256, n_check=200,
+                    min_recall=0.99, min_agreement=0.99):
+    """
+    Fit a ProjectedKNN for every wd in wds, reporting the size and dimension reduction, the recall
+    of the exact neighbours and the predict_proba agreement on n_check training rows used as
+    leave-one-out queries
+
+    Only projections reaching min_recall and min_agreement are saved as spd_knn_{wd}.proj.npz,
+    which load_knn_model prefers. For the others a warning is logged and any older projection is
+    removed, so the exact index stays in use.
+    """
+    report = []
+    for wd in wds:
+        hknn = load_knn_model(tradition, wd, projected=False)
+        if not isinstance(hknn, HellingerKNN):
+            hknn = HellingerKNN.from_spd_knn(hknn)
+        pknn = ProjectedKNN().fit_projection(hknn, method, n_components)
+
+        check_idx = np.linspace(0, len(hknn.U) - 1, min(n_check, len(hknn.U))).astype(int)
+        X_check = np.asarray(hknn.U[check_idx], dtype=np.float64) ** 2
+        recall = get_recall(hknn, pknn, X_check, check_idx)
+        agreement = float(np.mean(np.all(hknn.predict(X_check, check_idx) == pknn.predict(X_check, check_idx), axis=1)))
+        full_nbytes = len(hknn.U) * hknn.U.shape[1] * 4
+        report.append({'wd': wd, 'dim': hknn.U.shape[1], 'n_components': pknn.U.shape[1], 'recall': recall,
+                       'proba_agreement': agreement, 'float32_mb': full_nbytes / 1024 ** 2,
+                       'projected_mb': pknn.get_nbytes() / 1024 ** 2})
+        print('{} wd={}: {dim} -> {n_components} dims, {float32_mb:.1f} -> {projected_mb:.1f} MB, '
+              'recall {recall:.3f}, predict_proba agreement {proba_agreement:.3f}'.format(tradition, wd, **report[-1]))
+        path = get_knn_path(tradition, wd, 'proj.npz')
+        report[-1]['saved'] = recall >= min_recall and agreement >= min_agreement
+        if report[-1]['saved']:
+            pknn.save(path)
+        else:
+            logger.warning('%s wd=%s: recall %.3f or agreement %.3f is below %s / %s, keeping the exact index',
+                           tradition, wd, recall, agreement, min_recall, min_agreement)
+            if os.path.exists(path):
+                os.remove(path)
+    return report
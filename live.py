@@ -0,0 +1,174 @@
+import threading
+import time
+import numpy as np
+from scipy.io import wavfile
+
+
+class RingBuffer:
+    """
+    Single producer / single consumer audio ring buffer
+
+    The producer never blocks, when the consumer falls behind the oldest samples
+    are overwritten and counted in n_dropped.
+    """
+
+    def __init__(self, capacity):
+        self.data = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+        self.n_dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def write(self, samples):
+        samples = np.asarray(samples, dtype=np.float32)[-self.capacity:]
+        with self.cond:
+            n = len(samples)
+            overflow = max(0, self.size + n - self.capacity)
+            if overflow:
+                self.start = (self.start + overflow) % self.capacity
+                self.size -= overflow
+                self.n_dropped += overflow
+            end = (self.start + self.size) % self.capacity
+            first = min(n, self.capacity - end)
+            self.data[end:end + first] = samples[:first]
+            self.data[:n - first] = samples[first:]
+            self.size += n
+            self.cond.notify_all()
+
+    def read(self, n, timeout=None):
+        """
+        Block until n samples are available, returns None once closed and drained
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.size >= n or self.closed, timeout):
+                return None
+            if self.size < n:
+                return None
+            idx = (self.start + np.arange(n)) % self.capacity
+            samples = self.data[idx]
+            self.start = (self.start + n) % self.capacity
+            self.size -= n
+            self.cond.notify_all()
+            return samples
+
+    def wait_for_space(self, n):
+        with self.cond:
+            self.cond.wait_for(lambda: self.capacity - self.size >= n or self.closed)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class MicrophoneSource:
+    """
+    Callback driven sounddevice input stream, capture never waits for inference
+    """
+
+    def __init__(self, fs=16000, blocksize=1600):
+        self.fs = fs
+        self.blocksize = blocksize
+        self.stream = None
+
+    def start(self, ring):
+        import sounddevice as sd
+
+        def callback(indata, frames, time_info, status):
+            ring.write(indata[:, 0])
+
+        self.stream = sd.InputStream(samplerate=self.fs, channels=1, blocksize=self.blocksize,
+                                     dtype='float32', callback=callback)
+        self.stream.start()
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+
+class FileSource:
+    """
+    Offline stand-in for MicrophoneSource that plays a 16 kHz WAV file into the ring buffer
+
+    With realtime=False the file is pushed as fast as the ring buffer accepts it.
+    """
+
+    def __init__(self, file_path, fs=16000, blocksize=1600, realtime=True):
+        self.file_path = file_path
+        self.fs = fs
+        self.blocksize = blocksize
+        self.realtime = realtime
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self, ring):
+        sr, audio = wavfile.read(self.file_path)
+        if len(audio.shape) == 2:
+            audio = audio.mean(1)
+        audio = audio.astype(np.float32)
+
+        def play():
+            for i in range(0, len(audio), self.blocksize):
+                if self.stopped.is_set():
+                    break
+                if not self.realtime:
+                    ring.wait_for_space(self.blocksize)
+                ring.write(audio[i:i + self.blocksize])
+                if self.realtime:
+                    time.sleep(self.blocksize / self.fs)
+            ring.close()
+
+        self.thread = threading.Thread(target=play, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class LiveSession:
+    """
+    Overlaps capture and inference, the source fills a ring buffer while a worker
+    thread feeds every completed window to a StreamingRagaPredictor
+    """
+
+    def __init__(self, predictor, source, window=5, on_result=None, buffer_seconds=120):
+        self.predictor = predictor
+        self.source = source
+        self.window = int(window * predictor.model_srate)
+        self.on_result = on_result
+        self.ring = RingBuffer(int(buffer_seconds * predictor.model_srate))
+        self.worker = None
+        self.results = []
+        predictor.refresh_interval = window
+
+    def run_worker(self):
+        while True:
+            audio = self.ring.read(self.window)
+            if audio is None:
+                break
+            result = self.predictor.feed(audio)
+            if result is not None:
+                self.results.append(result)
+                if self.on_result is not None:
+                    self.on_result(result)
+
+    def start(self):
+        self.worker = threading.Thread(target=self.run_worker, daemon=True)
+        self.worker.start()
+        self.source.start(self.ring)
+
+    def stop(self):
+        self.ring.close()
+        self.source.stop()
+        self.join()
+
+    def join(self, timeout=None):
+        if self.worker is not None:
+            self.worker.join(timeout)
@@ -1,8 +1,16 @@
-from core import CRePE, SPD_Model
+from core import get_crepe, get_spd_model, preload_models, export_inference_models, export_tflite_pitch_model
+from model_registry import registry
 import recorder
+import live
+import batch
+import ensemble_pruning
+import instrumentation
+import logging
 import os
 import data_utils
-from scipy.io import wavfile
+import knn_index
+from feature_cache import FeatureCache
+from streaming import StreamingRagaPredictor
 import argparse
 import numpy as np
 import math
@@ -24,21 +32,47 @@ def predict_run_time(crepe, cretora_hindustani, cretora_carnatic, tradition='h',
         else:
             print('Predicted Raga: {}'.format(pred_raga))
 
-def predict_on_file(crepe, cretora, file_path, tonic):
-    split_tup = os.path.splitext(file_path)
-
-    if split_tup[1] == '.mp3':
-        audio = data_utils.mp3_to_wav(file_path)
+def predict_run_time_stream(crepe, cretora, tonic=None, seconds=60, refresh=5, file_path=None):
+    predictor = StreamingRagaPredictor(crepe, cretora, tonic=tonic, refresh_interval=refresh)
+    if file_path is None:
+        source = live.MicrophoneSource()
     else:
-        sr, audio = wavfile.read(file_path)
-        if len(audio.shape) == 2:
-            audio = audio.mean(1)
+        source = live.FileSource(file_path)
+
+    def on_result(pred):
+        print('Predicted Tonic: {} and Raga: {}'.format(pred[0], pred[1]))
 
-    pitches = crepe.predict_pitches(audio)
-    print("Pitch Prediction Complete")
+    session = live.LiveSession(predictor, source, window=refresh, on_result=on_result)
+    print('Started recording for {} seconds'.format(seconds))
+    session.start()
+    try:
+        session.join(seconds)
+    except KeyboardInterrupt:
+        pass
+    session.stop()
+    print('Stopped recording')
 
-    # pitches = crepe.predict_pitches(audio)
-    pred_tonic, pred_raga = cretora.predict_tonic_raga(crepe, audio, pitches, tonic)
+def get_audio_pitches(crepe, file_path, tonic):
+    # the audio is only kept for the tonic CQT when the tonic is predicted
+    return crepe.predict_pitches_file(file_path, keep_audio=tonic is None)
+
+def predict_on_file(crepe, cretora, file_path, tonic, cache=None):
+    if cache is None:
+        audio, pitches = get_audio_pitches(crepe, file_path, tonic)
+        pred_tonic, pred_raga = cretora.predict_tonic_raga(crepe, audio, pitches, tonic)
+    else:
+        # the audio is only decoded when a stage it feeds is missing from the cache
+        cache_key = cache.get_key_for_file(file_path)
+        audio = None
+        pitches = cache.load(cache_key, 'pitches')
+        if pitches is None:
+            audio, pitches = get_audio_pitches(crepe, file_path, tonic)
+            cache.save(cache_key, 'pitches', pitches)
+        if audio is None and tonic is None and not os.path.exists(cache.get_path(cache_key, cretora.get_hist_cqt_name())):
+            audio = data_utils.load_audio(file_path)
+        pred_tonic, pred_raga = cretora.predict_tonic_raga(crepe, audio, pitches, tonic, cache=cache,
+                                                           cache_key=cache_key)
+        print('Cache hits: {hits}, misses: {misses}'.format(**cache.stats()))
 
     print('Predicted Tonic: {} and Raga: {}'.format(pred_tonic, pred_raga))
 
@@ -101,20 +135,142 @@ if __name__ == '__main__':
                             help='sets the tradition - [h]industani/[c]arnatic')
     arg_parser.add_argument('--tonic', default=None,
                             help='sets the tonic if given, otherwise tonic is predicted')
+    arg_parser.add_argument('--stream', default=False,
+                            help='updates the raga prediction every --refresh seconds while recording')
+    arg_parser.add_argument('--refresh', default=5,
+                            help='sets the refresh interval of the streaming prediction in seconds')
+    arg_parser.add_argument('--stream_file', default=None,
+                            help='plays this 16 kHz wav file instead of the microphone in streaming mode')
+    arg_parser.add_argument('--cache_dir', default=None,
+                            help='caches pitches and SPD features of analysed files in this directory')
+    arg_parser.add_argument('--cache_size', default=2048,
+                            help='sets the maximum size of the feature cache in MB')
+    arg_parser.add_argument('--batch_dir', default=None,
+                            help='scores every wav/mp3 file under this directory')
+    arg_parser.add_argument('--manifest', default=None,
+                            help='scores the audio files listed in this file, one path per line')
+    arg_parser.add_argument('--output', default='batch_results.tsv',
+                            help='sets the TSV file the batch results are appended to')
+    arg_parser.add_argument('--workers', default=None,
+                            help='sets the number of batch worker processes, defaults to the number of cores')
+    arg_parser.add_argument('--threads', default=None,
+                            help='sets the TF threads of every batch worker, defaults to cores / workers')
+    arg_parser.add_argument('--convert_knn', default=False,
+                            help='converts the pickled SPD-KNN models of the tradition to Hellinger KNN indexes')
+    arg_parser.add_argument('--migrate_knn_store', default=None,
+                            help='writes the memory-mapped KNN feature store of the tradition - float32/float16')
+    arg_parser.add_argument('--fit_projection', default=None,
+                            help='fits reduced KNN indexes for the wd >= 120 raga models - pca/random')
+    arg_parser.add_argument('--n_components', default=256,
+                            help='sets the number of dimensions kept by --fit_projection')
+    arg_parser.add_argument('--min_recall', default=0.99,
+                            help='--fit_projection only saves indexes with at least this neighbour recall')
+    arg_parser.add_argument('--min_agreement', default=0.99,
+                            help='--fit_projection only saves indexes with at least this predict_proba agreement')
+    arg_parser.add_argument('--export_models', default=False,
+                            help='writes frozen inference graphs of the pitch and tonic models and checks them '
+                                 'against the keras models on --runtime_file')
+    arg_parser.add_argument('--export_tflite', default=None,
+                            help='writes the quantized TFLite pitch model, dynamic or int8 (calibrated on data/sample_data)')
+    arg_parser.add_argument('--pitch_backend', default=None,
+                            help='sets the pitch model backend - auto/keras/tflite, defaults to experiments.conf')
+    arg_parser.add_argument('--prune_manifest', default=None,
+                            help='prunes the raga model ensemble on this labelled file of path, raga and optional '
+                                 'tonic per line and saves it as the --profile_name ensemble profile')
+    arg_parser.add_argument('--latency_budget', default=50,
+                            help='sets the raga ensemble latency budget per clip in ms for --prune_manifest')
+    arg_parser.add_argument('--test_fraction', default=0.3,
+                            help='sets the fraction of --prune_manifest clips held out to report the accuracy on')
+    arg_parser.add_argument('--profile_name', default='pruned',
+                            help='sets the name of the ensemble profile written by --prune_manifest')
+    arg_parser.add_argument('--ensemble_profile', default=None,
+                            help='selects a saved raga ensemble profile, defaults to experiments.conf')
+    arg_parser.add_argument('--instrument', default=None,
+                            help='times every prediction stage - log, json:<path> or hist (summary at exit)')
+    arg_parser.add_argument('--load_times', default=False,
+                            help='prints the load time of every model artifact at exit')
 
     p_args = arg_parser.parse_args()
 
-    crepe = CRePE()
+    hist_sink = None
+    if p_args.instrument == 'log':
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+        instrumentation.instruments.enable(instrumentation.LogSink())
+    elif p_args.instrument == 'hist':
+        hist_sink = instrumentation.HistogramSink()
+        instrumentation.instruments.enable(hist_sink)
+    elif p_args.instrument and p_args.instrument.startswith('json:'):
+        instrumentation.instruments.enable(instrumentation.JSONSink(p_args.instrument[len('json:'):]))
+
+    if p_args.convert_knn:
+        knn_index.convert_spd_knn_models('Hindustani' if p_args.tradition == 'h' else 'Carnatic')
+        exit(0)
+
+    if p_args.fit_projection:
+        knn_index.fit_projections('Hindustani' if p_args.tradition == 'h' else 'Carnatic',
+                                  method=p_args.fit_projection, n_components=int(p_args.n_components),
+                                  min_recall=float(p_args.min_recall), min_agreement=float(p_args.min_agreement))
+        exit(0)
+
+    if p_args.migrate_knn_store:
+        knn_index.migrate_knn_store('Hindustani' if p_args.tradition == 'h' else 'Carnatic', p_args.migrate_knn_store)
+        exit(0)
+
+    if p_args.export_models:
+        export_inference_models('Hindustani' if p_args.tradition == 'h' else 'Carnatic', p_args.runtime_file)
+        exit(0)
+
+    if p_args.export_tflite:
+        export_tflite_pitch_model(p_args.export_tflite)
+        exit(0)
 
-    if p_args.runtime:
-        cretora_hindustani = SPD_Model('Hindustani')
-        cretora_carnatic= SPD_Model('Hindustani')
+    if p_args.batch_dir or p_args.manifest:
+        if p_args.batch_dir:
+            files = batch.list_batch_dir(p_args.batch_dir)
+        else:
+            files = batch.read_manifest(p_args.manifest)
+        batch.run_batch(files, p_args.output, 'Hindustani' if p_args.tradition == 'h' else 'Carnatic',
+                        tonic=p_args.tonic,
+                        workers=int(p_args.workers) if p_args.workers else None,
+                        threads=int(p_args.threads) if p_args.threads else None,
+                        ensemble_profile=p_args.ensemble_profile)
+        exit(0)
+
+    tradition = 'Hindustani' if p_args.tradition == 'h' else 'Carnatic'
+    if p_args.ensemble_profile:
+        get_spd_model(tradition).set_ensemble_profile(p_args.ensemble_profile)
+    if p_args.prune_manifest:
+        ensemble_pruning.run_pruning(get_crepe(backend=p_args.pitch_backend), get_spd_model(tradition),
+                                     p_args.prune_manifest, float(p_args.latency_budget), p_args.profile_name,
+                                     test_fraction=float(p_args.test_fraction))
+        exit(0)
+
+    # the raga (and tonic) models of the tradition load in the background while CRePE is built
+    preload_models(tradition, tonic=p_args.tonic is None)
+    crepe = get_crepe(backend=p_args.pitch_backend)
+
+    if p_args.runtime and p_args.stream:
+        cretora = get_spd_model(tradition)
+        predict_run_time_stream(crepe, cretora, tonic=p_args.tonic, seconds=int(p_args.duration),
+                                refresh=int(p_args.refresh), file_path=p_args.stream_file)
+
+    elif p_args.runtime:
+        # models are only loaded for the tradition that is actually predicted
+        cretora_hindustani = get_spd_model('Hindustani')
+        cretora_carnatic = get_spd_model('Carnatic')
         predict_run_time(crepe, cretora_hindustani, cretora_carnatic,
                          tradition=p_args.tradition, tonic=p_args.tonic, seconds=int(p_args.duration))
 
     elif p_args.runtime_file:
-        if p_args.tradition == 'h':
-            cretora = SPD_Model('Hindustani')
-        else:
-            cretora = SPD_Model('Carnatic')
-        predict_on_file(crepe, cretora, p_args.runtime_file, p_args.tonic)
+        cretora = get_spd_model(tradition)
+        cache = None
+        if p_args.cache_dir:
+            cache = FeatureCache(p_args.cache_dir, crepe.pitch_config, weights_path=crepe.model_path,
+                                 max_bytes=int(p_args.cache_size) * 1024 ** 2, backend=crepe.backend)
+        predict_on_file(crepe, cretora, p_args.runtime_file, p_args.tonic, cache)
+
+    if p_args.load_times:
+        print(registry.report())
+
+    if hist_sink is not None:
+        print(hist_sink.report())
@@ -0,0 +1,62 @@
+import threading
+import time
+
+
+class ModelRegistry:
+    """
+    Process-wide store of loaded models, every artifact is loaded on first use and then shared
+
+    A loader runs at most once per key, concurrent callers of the same key wait for the
+    first one. load_times keeps the seconds spent loading every artifact.
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.load_times = {}
+        self.key_locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, loader):
+        with self.lock:
+            if key in self.models:
+                return self.models[key]
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self.models:
+                t0 = time.time()
+                model = loader()
+                with self.lock:
+                    self.load_times[key] = time.time() - t0
+                    self.models[key] = model
+        return self.models[key]
+
+    def is_loaded(self, key):
+        with self.lock:
+            return key in self.models
+
+    def preload(self, items, background=True):
+        """
+        Load a list of (key, loader) in order, in a daemon thread unless background is False
+
+        Returns the thread, callers that need a model simply get() it and wait for the load.
+        """
+        def run():
+            for key, loader in items:
+                self.get(key, loader)
+
+        if not background:
+            run()
+            return None
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def report(self):
+        with self.lock:
+            load_times = sorted(self.load_times.items())
+        lines = ['{}: {:.2f}s'.format(key, t) for key, t in load_times]
+        lines.append('total: {:.2f}s'.format(sum(t for _, t in load_times)))
+        return '\n'.join(lines)
+
+
+registry = ModelRegistry()
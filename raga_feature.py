@@ -2,12 +2,13 @@ import numpy as np
 import math
 from collections import defaultdict
 import h5py
+import instrumentation
 
 def freq_to_cents_np(freq, cents_mapping, std=25):
     frequency_reference = 10
     c_true = 1200 * np.log2((np.array(freq)+1e-5) / frequency_reference)
     c_true = np.expand_dims(c_true, 1)
-    cents_mapping = np.tile(np.expand_dims(cents_mapping,0), [c_true.shape[0],1])
+    # broadcast [T, 1] against [720], the cents mapping is never tiled per frame
     target = np.exp(-(cents_mapping - c_true) ** 2 / (2 * std ** 2))
     pitch_cent = np.sum(target.reshape([c_true.shape[0], 6, 120]), 1)
     return pitch_cent
@@ -57,10 +58,20 @@ def relax_fun(p,add,r=4):
 
 
 def get_dist_btw_idx(pitchvalue_prob, start_idx, end_idx):
-    dist = 0
-    for i in range(start_idx, end_idx + 1):
-        dist += pitchvalue_prob[i]
-    return dist
+    return np.sum(pitchvalue_prob[start_idx:end_idx + 1], axis=0)
+
+
+def get_cum_dist(pitchvalue_prob):
+    """
+    Prefix table of the pitch matrix, cum_dist[i] is the sum of the first i rows
+    """
+    cum_dist = np.zeros([len(pitchvalue_prob) + 1, pitchvalue_prob.shape[1]])
+    np.cumsum(pitchvalue_prob, axis=0, out=cum_dist[1:])
+    return cum_dist
+
+
+def get_dist_btw_idx_cum(cum_dist, start_idx, end_idx):
+    return cum_dist[end_idx + 1] - cum_dist[start_idx]
 
 
 def get_dist_btw_shortlisted_idxs(pitchvalue_prob, shortlisted_idxs, off_start=0, off_end=None):
@@ -82,6 +93,23 @@ def get_dist_btw_shortlisted_idxs(pitchvalue_prob, shortlisted_idxs, off_start=0
     return normalize(dist)
 
 
+def get_dist_btw_shortlisted_idxs_cum(cum_dist, shortlisted_idxs, off_start=0, off_end=None):
+    """
+    Same as get_dist_btw_shortlisted_idxs but every span costs one subtraction on the prefix table
+    """
+    if off_end is None:
+        off_end = len(cum_dist) - 2
+    sidx = np.array(shortlisted_idxs, dtype=np.int64).reshape([-1, 4])
+    i1, i2, i3, i4 = sidx[:, 0], sidx[:, 1], sidx[:, 2], sidx[:, 3]
+    keep = (i2 >= off_start) & (i3 <= off_end)
+    i1 = np.where((i1 <= off_start) & (off_start <= i2), off_start, i1)[keep]
+    i4 = np.where((i3 <= off_end) & (off_end <= i4), off_end, i4)[keep]
+    if len(i1) == 0:
+        return normalize(0)
+    dist = np.sum(cum_dist[i4 + 1], axis=0) - np.sum(cum_dist[i1], axis=0)
+    return normalize(dist)
+
+
 def update_shortlisted_index(shortlisted_index, pitch_st_mapping, start_index, end_index):
     psm_ss = pitch_st_mapping[start_index][0]
     psm_se = pitch_st_mapping[start_index][1]
@@ -249,13 +277,84 @@ def full_spd(pitches_arg, lm_file):
                 shortlisted_index = compute_spd_ps_pe(start_idx, std_pitches, pitch_st_mapping, s, e, asc)
                 lm_file["{}_{}_{}".format(s, e, asc)] = shortlisted_index
 
+
+def get_std_idx_np(pitches_arg):
+    """
+    Run-length encode the note sequence, vectorized version of get_std_idx
+
+    Returns the note of every run and the first/last frame of every run
+    """
+    std_pitches = np.asarray(pitches_arg) // 10
+    n = len(std_pitches)
+    run_starts = np.flatnonzero(np.diff(std_pitches)) + 1
+    run_starts = np.concatenate([[0], run_starts])
+    run_ends = np.concatenate([run_starts[1:] - 1, [n - 1]])
+    return std_pitches[run_starts], run_starts, run_ends
+
+
+def full_spd_np(pitches_arg, lm_file):
+    """
+    Vectorized version of full_spd, fills lm_file with the same shortlisted_index lists
+
+    For a start note ps, compute_spd_ps_pe accepts the span (i, j) iff run i is ps,
+    run j is pe and every run in between lies strictly inside the (ps, pe) interval
+    walked in the asc/desc direction. Measuring every run by its offset from ps, these
+    are exactly the runs where the offset reaches a new maximum before ps occurs again,
+    so one cumulative max per (ps, asc) yields the spans of all 11 end notes at once.
+    """
+    std_pitches, run_starts, run_ends = get_std_idx_np(pitches_arg)
+    n = len(std_pitches)
+    fallback = (int(run_starts[0]), int(run_ends[0]), int(run_starts[-1]), int(run_ends[-1]))
+    for asc in [True, False]:
+        for s in range(0, 12, 1):
+            if asc:
+                offset = (std_pitches - s) % 12
+            else:
+                offset = (s - std_pitches) % 12
+            is_start = offset == 0
+            segment = np.cumsum(is_start)
+            # segment*12 keeps the running max from leaking across start notes
+            key = segment * 12 + offset
+            prev_max = np.maximum.accumulate(np.concatenate([[-1], key[:-1]]))
+            is_end = (key > prev_max) & (~is_start) & (segment > 0)
+            end_idx = np.flatnonzero(is_end)
+            start_idx = np.flatnonzero(is_start)[segment[end_idx] - 1]
+            if asc:
+                end_notes = (s + offset[end_idx]) % 12
+            else:
+                end_notes = (s - offset[end_idx]) % 12
+            for e in range(0, 12, 1):
+                if s==e:
+                    continue
+                sel = end_notes == e
+                i = start_idx[sel]
+                j = end_idx[sel]
+                shortlisted_index = list(zip(run_starts[i].tolist(), run_ends[i].tolist(),
+                                             run_starts[j].tolist(), run_ends[j].tolist()))
+                # compute_spd_ps_pe only marks the SPD as present for spans closed before the last run
+                if not np.any(j < n - 1):
+                    shortlisted_index.append(fallback)
+                lm_file["{}_{}_{}".format(s, e, asc)] = shortlisted_index
+
+
 def generate_spd_idx_all_files(pitchvalue_prob):
     spd_idx_lm_file = {}
     pitches_arg = np.argmax(pitchvalue_prob, axis=1)
     #                 pitch_dict = get_full_spd_st(pitches_arg, mbid, spd_idx_lm_file)
-    full_spd(pitches_arg, spd_idx_lm_file)
+    full_spd_np(pitches_arg, spd_idx_lm_file)
     return spd_idx_lm_file
 
+
+def check_spd_equivalence(pitches_arg):
+    """
+    Compare full_spd_np against the reference full_spd on a pitch argmax sequence
+    """
+    lm_file = {}
+    lm_file_np = {}
+    full_spd(pitches_arg, lm_file)
+    full_spd_np(pitches_arg, lm_file_np)
+    return lm_file == lm_file_np
+
 def get_cliped_dist(s,e,asc,dist,clip=15):
     s10 = s*10
     e10 = e*10
@@ -288,8 +387,48 @@ def get_cliped_dist(s,e,asc,dist,clip=15):
             m+=1
     return dist_sliced
 
+def get_cliped_idx(s,e,asc,clip=15):
+    """
+    Bins of the 120 bin histogram kept by get_cliped_dist, they do not depend on the histogram
+    """
+    if asc:
+        step = 1
+    else:
+        step = -1
+    i = modulo(s*10-step*clip)
+    j = modulo(e*10+step*clip)
+    m = modulo(step*(j-i))
+    if m<=clip:
+        return np.arange(120)
+    return modulo(i + step*np.arange(1, m+1))
+
+def get_raga_feat_idx(wd, clip=15):
+    """
+    Flat indices into full_spd_dist [12,12,120,2] of the wd feature, None for wd 0 (the histogram)
+    """
+    if wd == 0:
+        return None
+    if wd >= 240:
+        return np.arange(12*12*120*2)
+    if wd < 120:
+        pairs = [(s, modulo(s+wd)) for s in range(0,120,10)]
+    else:
+        pairs = [(wd-120, e) for e in range(0,120,10)]
+    feat_idx = []
+    for s, e in pairs:
+        if s==e:
+            continue
+        s10 = s//10
+        e10 = e//10
+        feat_idx.append(((s10*12 + e10)*120 + get_cliped_idx(s,e,True,clip))*2)
+        feat_idx.append(((e10*12 + s10)*120 + get_cliped_idx(e,s,False,clip))*2 + 1)
+    return np.concatenate(feat_idx)
+
+RAGA_FEAT_IDX = {wd: get_raga_feat_idx(wd) for wd in range(0,250,10)}
+
 def get_spd_from_idx(pitchvalue_prob, off_start=0, off_end=None):
-    dist_hist = get_dist_btw_idx(pitchvalue_prob, 0, len(pitchvalue_prob)-1)
+    cum_dist = get_cum_dist(pitchvalue_prob)
+    dist_hist = get_dist_btw_idx_cum(cum_dist, 0, len(pitchvalue_prob)-1)
     dist_hist = normalize(dist_hist)
     spd_idx_lm_file = generate_spd_idx_all_files(pitchvalue_prob)
     full_spd_dist = np.zeros([12,12,120,2])
@@ -301,7 +440,7 @@ def get_spd_from_idx(pitchvalue_prob, off_start=0, off_end=None):
                     full_spd_dist[s,e,:,asc_int] = dist_hist
                     continue
                 shortlisted_idxs = spd_idx_lm_file['{}_{}_{}'.format(s, e, asc)]
-                dist = get_dist_btw_shortlisted_idxs(pitchvalue_prob,shortlisted_idxs, off_start, off_end)
+                dist = get_dist_btw_shortlisted_idxs_cum(cum_dist, shortlisted_idxs, off_start, off_end)
 
                 if np.sum(dist)==0:
                     full_spd_dist[s, e, :, asc_int] = dist_hist
@@ -313,61 +452,89 @@ def generate_full_spd_cache(pitchvalue_prob):
     full_spd_dist, dist_hist = get_spd_from_idx(pitchvalue_prob)
     return full_spd_dist, dist_hist
 
+def get_raga_feat_wd(full_spd_dist, dist_hist, wd):
+    """
+    Feature vector of the wd model, one gather on full_spd_dist through RAGA_FEAT_IDX
+    """
+    if wd == 0:
+        return np.array(dist_hist)
+    return np.reshape(full_spd_dist, [-1])[RAGA_FEAT_IDX[wd]]
+
+def get_raga_feat_wd_ref(full_spd_dist, dist_hist, wd):
+    """
+    Reference version of get_raga_feat_wd that slices every histogram with get_cliped_dist
+    """
+    if wd == 0:
+        feat = np.array(dist_hist)
+    elif 0<wd<120:
+        feat_curr = []
+        for s in range(0,120,10):
+            e = modulo(s+wd)
+            if s==e:
+                continue
+            s10 = s//10
+            e10 = e//10
+            hist_1 = full_spd_dist[s10,e10,:,0]
+            hist_2 = full_spd_dist[e10,s10,:,1]
+            hist_1 = get_cliped_dist(s,e,True,hist_1,clip=15)
+            hist_2 = get_cliped_dist(e,s,False,hist_2,clip=15)
+            feat_curr.append(hist_1)
+            feat_curr.append(hist_2)
+        feat = np.concatenate(feat_curr, axis=-1)
+    elif 120<=wd<240:
+        s = wd-120
+        feat_curr = []
+        for e in range(0,120,10):
+            if s==e:
+                continue
+            s10 = s//10
+            e10 = e//10
+            hist_1 = full_spd_dist[s10,e10,:,0]
+            hist_2 = full_spd_dist[e10,s10,:,1]
+            hist_1 = get_cliped_dist(s,e,True,hist_1,clip=15)
+            hist_2 = get_cliped_dist(e,s,False,hist_2,clip=15)
+            feat_curr.append(hist_1)
+            feat_curr.append(hist_2)
+        feat = np.concatenate(feat_curr, axis=-1)
+    else:
+        feat = np.reshape(full_spd_dist, [-1])
+    return feat
+
 def get_raga_feat_and_predict(knn_models, pitchvalue_prob, n_labels):
-    full_spd_dist, dist_hist = generate_full_spd_cache(pitchvalue_prob)
+    with instrumentation.span('spd'):
+        full_spd_dist, dist_hist = generate_full_spd_cache(pitchvalue_prob)
     pred_proba = np.zeros([25, n_labels])
-    for wd in range(0,250,10):
-        spd_knn = knn_models[wd]
-        n_rows = 1
-        if wd == 0:
-            feat = np.zeros([n_rows, 120])
-            feat[0] = dist_hist
-        elif 0<wd<120:
-            feat = []
-            feat_curr = []
-            for s in range(0,120,10):
-                e = modulo(s+wd)
-                if s==e:
-                    continue
-                s10 = s//10
-                e10 = e//10
-                hist_1 = full_spd_dist[s10,e10,:,0]
-                hist_2 = full_spd_dist[e10,s10,:,1]
-                hist_1 = get_cliped_dist(s,e,True,hist_1,clip=15)
-                hist_2 = get_cliped_dist(e,s,False,hist_2,clip=15)
-                feat_curr.append(hist_1)
-                feat_curr.append(hist_2)
-#                 if feat_curr is None:
-#                     feat_curr = np.concatenate([hist_1, hist_2], axis=-1)
-#                 else:
-#                     feat_curr = np.concatenate([feat_curr, hist_1], axis=-1)
-#                     feat_curr = np.concatenate([feat_curr, hist_2], axis=-1)
-            feat_curr = np.concatenate(feat_curr, axis=-1)
-#             feat[row[0]] = feat_curr
-            feat.append(feat_curr)
-        elif 120<=wd<240:
-            feat = []
-            s = wd-120
-            feat_curr = []
-            for e in range(0,120,10):
-                if s==e:
-                    continue
-                s10 = s//10
-                e10 = e//10
-                hist_1 = full_spd_dist[s10,e10,:,0]
-                hist_2 = full_spd_dist[e10,s10,:,1]
-                hist_1 = get_cliped_dist(s,e,True,hist_1,clip=15)
-                hist_2 = get_cliped_dist(e,s,False,hist_2,clip=15)
-                feat_curr.append(hist_1)
-                feat_curr.append(hist_2)
-            feat_curr = np.concatenate(feat_curr, axis=-1)
-            feat.append(feat_curr)
-        else:
-            feat = []
-            hist_1 = np.array(full_spd_dist)
-            feat.append(np.reshape(hist_1, [-1]))
-        feat = np.array(feat)
-        pred_proba[wd//10] = spd_knn.predict(feat)
+    with instrumentation.span('knn'):
+        for wd in range(0,250,10):
+            with instrumentation.span('wd_{}'.format(wd)):
+                spd_knn = knn_models[wd]
+                feat = np.expand_dims(get_raga_feat_wd(full_spd_dist, dist_hist, wd), 0)
+                pred_proba[wd//10] = spd_knn.predict(feat)
+    return pred_proba
+
+def get_raga_feat_and_predict_batch(knn_models, spd_caches, n_labels, wds=None):
+    """
+    Score many clips with one predict call per wd model
+
+    spd_caches is a list of (full_spd_dist, dist_hist) as returned by generate_full_spd_cache,
+    returns pred_proba of shape (n_clips, 25, n_labels) in input order. Only the models in wds
+    (default all) are evaluated, the rows of the others stay zero.
+    """
+    pred_proba = np.zeros([len(spd_caches), 25, n_labels])
+    if len(spd_caches) == 0:
+        return pred_proba
+    if wds is None:
+        wds = range(0,250,10)
+    full_spd_dists = np.stack([np.reshape(full_spd_dist, [-1]) for full_spd_dist, _ in spd_caches])
+    with instrumentation.span('knn'):
+        for wd in wds:
+            with instrumentation.span('wd_{}'.format(wd)):
+                spd_knn = knn_models[wd]
+                if wd == 0:
+                    feat = np.stack([dist_hist for _, dist_hist in spd_caches])
+                else:
+                    feat = full_spd_dists[:, RAGA_FEAT_IDX[wd]]
+                pred_proba[:, wd//10] = spd_knn.predict(feat)
     return pred_proba
 
 def get_range_dict(relax_sign, asc):
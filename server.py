@@ -0,0 +1,379 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import http.client
+from urllib.parse import urlsplit, parse_qs, urlencode
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import data_utils
+
+TRADITIONS = {'h': 'Hindustani', 'c': 'Carnatic', 'Hindustani': 'Hindustani', 'Carnatic': 'Carnatic'}
+AUDIO_TYPES = {'audio/wav': 'wav', 'audio/x-wav': 'wav', 'audio/wave': 'wav', 'audio/mpeg': 'mp3', 'audio/mp3': 'mp3'}
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class MicroBatcher:
+    """
+    Groups items submitted by concurrent requests and runs fn once per group in executor
+
+    A batch is closed window seconds after its first item arrives or once the summed size
+    of its items reaches max_size. fn takes the list of items and returns one result per item.
+    The queue holds at most max_queue items, submit() waits while it is full.
+    """
+
+    def __init__(self, fn, executor, max_size=8, window=0.01, max_queue=64, size=None):
+        self.fn = fn
+        self.executor = executor
+        self.max_size = max_size
+        self.window = window
+        self.size = size or (lambda item: 1)
+        self.queue = asyncio.Queue(max_queue)
+        self.n_batches = 0
+        self.n_items = 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def submit(self, item):
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            size = self.size(batch[0][0])
+            deadline = loop.time() + self.window
+            while size < self.max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                size += self.size(batch[-1][0])
+
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.fn, items)
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self.n_batches += 1
+            self.n_items += len(batch)
+
+    def stats(self):
+        return {'batches': self.n_batches, 'items': self.n_items, 'queued': self.queue.qsize(),
+                'mean_batch': self.n_items / max(self.n_batches, 1)}
+
+
+def split_rows(arrays, stacked):
+    # inverse of np.concatenate(arrays) along the first axis
+    return np.split(stacked, np.cumsum([len(a) for a in arrays])[:-1])
+
+
+class InferenceServer:
+    """
+    asyncio HTTP front end over resident models, requests never wait on inference in the event loop
+
+    Audio decoding, framing, CQT and SPD run on a CPU thread pool. The pitch CNN and the tonic
+    model run on a single inference thread, fed by micro-batchers that merge the frame chunks
+    (and hist_cqts) of concurrent requests, the raga KNN ensemble is micro-batched per tradition
+    the same way. At most max_pending requests are admitted, further ones get 503 before their upload is read.
+    """
+
+    def __init__(self, crepe, spd_models, window=0.02, max_batch_frames=8192, max_batch_clips=16,
+                 max_pending=32, max_body=256 * 1024 ** 2, cpu_threads=None):
+        self.crepe = crepe
+        self.spd_models = spd_models
+        self.window = window
+        self.max_batch_frames = max_batch_frames
+        self.max_batch_clips = max_batch_clips
+        self.max_pending = max_pending
+        self.max_body = max_body
+        self.cpu_pool = ThreadPoolExecutor(cpu_threads or os.cpu_count())
+        self.inference_pool = ThreadPoolExecutor(1)
+        self.chunk_frames = max(1, max_batch_frames // 2)
+        self.pending = 0
+        self.started = time.time()
+        self.counts = {'requests': 0, 'completed': 0, 'errors': 0, 'rejected': 0}
+        self.latencies = []
+        self.batchers = {}
+
+    def start_batchers(self):
+        self.batchers['pitch'] = MicroBatcher(self.predict_frames_batch, self.inference_pool, self.max_batch_frames,
+                                              self.window, size=len)
+        for tradition, spd_model in self.spd_models.items():
+            self.batchers['tonic/' + tradition] = MicroBatcher(
+                lambda hists, spd_model=spd_model: list(spd_model.predict_tonic_from_hist(np.concatenate(hists))),
+                self.inference_pool, self.max_batch_clips, self.window)
+            self.batchers['knn/' + tradition] = MicroBatcher(
+                lambda caches, spd_model=spd_model: list(spd_model.predict_raga_proba(caches)),
+                self.cpu_pool, self.max_batch_clips, self.window)
+        for batcher in self.batchers.values():
+            batcher.start()
+
+    def predict_frames_batch(self, frame_chunks):
+        return split_rows(frame_chunks, self.crepe.predict_frames(np.concatenate(frame_chunks)))
+
+    async def run_cpu(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.cpu_pool, fn, *args)
+
+    async def predict(self, audio, tradition, tonic=None):
+        spd_model = self.spd_models[tradition]
+        timings = {}
+        t0 = time.time()
+
+        # the same voice activity gate as CRePE.predict_pitches
+        voiced = None
+        if self.crepe.pitch_config.get('vad', False):
+            voiced = await self.run_cpu(data_utils.get_voiced_mask, audio, self.crepe.pitch_config)
+            if not np.any(voiced):
+                voiced = None
+        frame_chunks = data_utils.audio_2_frame_chunks(audio, self.crepe.pitch_config, self.chunk_frames)
+        pitches = []
+        i = 0
+        while True:
+            frames = await self.run_cpu(next, frame_chunks, None)
+            if frames is None:
+                break
+            if voiced is not None:
+                frames = frames[voiced[i * self.chunk_frames:(i + 1) * self.chunk_frames]]
+            i += 1
+            if len(frames) > 0:
+                pitches.append(await self.batchers['pitch'].submit(frames))
+        pitches = np.concatenate(pitches)
+        timings['pitch'] = time.time() - t0
+
+        t1 = time.time()
+        if tonic is None:
+            hist_cqt = await self.run_cpu(data_utils.get_hist_cqt, audio, pitches, spd_model.tonic_config['cqt_stride'])
+            pred_tonic = await self.batchers['tonic/' + tradition].submit(hist_cqt)
+            tonic_12, tonic_idx = spd_model.get_tonic_from_pred(pred_tonic)
+        else:
+            tonic_12, tonic_idx = spd_model.get_tonic_from_name(tonic)
+        timings['tonic'] = time.time() - t1
+
+        t2 = time.time()
+        spd_cache = await self.run_cpu(spd_model.get_spd_cache, self.crepe, pitches, tonic_idx)
+        pred_proba = await self.batchers['knn/' + tradition].submit(spd_cache)
+        pred_raga = spd_model.get_raga_from_proba(pred_proba)
+        timings['raga'] = time.time() - t2
+        return {'tonic': tonic_12, 'raga': pred_raga, 'tradition': tradition,
+                'audio_seconds': len(audio) / 16000,
+                'skipped_fraction': 0.0 if voiced is None else float(1 - np.mean(voiced)), 'timings': timings}
+
+    def load_upload(self, body, ext):
+        with tempfile.NamedTemporaryFile(suffix='.' + ext) as f:
+            f.write(body)
+            f.flush()
+            return data_utils.load_audio(f.name)
+
+    async def handle_predict(self, query, headers, body):
+        content_type = headers.get('content-type', '').split(';')[0].strip()
+        if content_type == 'application/json':
+            params = json.loads(body.decode() or '{}')
+        else:
+            params = {k: v[0] for k, v in query.items()}
+        tradition = TRADITIONS.get(params.get('tradition', 'h'))
+        if tradition not in self.spd_models:
+            return 400, {'error': 'unknown tradition {}'.format(params.get('tradition'))}
+
+        if content_type == 'application/json':
+            if 'path' not in params:
+                return 400, {'error': 'json requests need a path'}
+            audio = await self.run_cpu(data_utils.load_audio, params['path'])
+        else:
+            ext = AUDIO_TYPES.get(content_type, params.get('format', 'wav'))
+            audio = await self.run_cpu(self.load_upload, body, ext)
+        return 200, await self.predict(audio, tradition, params.get('tonic') or None)
+
+    def get_metrics(self):
+        latencies = np.asarray(self.latencies[-1000:]) if self.latencies else np.zeros(1)
+        return {'uptime': time.time() - self.started,
+                'pending': self.pending,
+                'counts': self.counts,
+                'latency_p50': float(np.percentile(latencies, 50)),
+                'latency_p95': float(np.percentile(latencies, 95)),
+                'batchers': {name: batcher.stats() for name, batcher in self.batchers.items()}}
+
+    async def route(self, method, target, headers, read_body):
+        """
+        read_body is awaited for the request body, predict requests are admitted before their upload is read
+        """
+        url = urlsplit(target)
+        if method == 'POST' and url.path == '/predict':
+            self.counts['requests'] += 1
+            if self.pending >= self.max_pending:
+                self.counts['rejected'] += 1
+                return 503, {'error': 'server busy, {} requests pending'.format(self.pending)}
+            self.pending += 1
+            t0 = time.time()
+            try:
+                body = await read_body()
+                status, payload = await self.handle_predict(parse_qs(url.query), headers, body)
+            except Exception as e:
+                self.counts['errors'] += 1
+                return 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+            finally:
+                self.pending -= 1
+            self.counts['completed'] += 1
+            self.latencies.append(time.time() - t0)
+            del self.latencies[:-1000]
+            return status, payload
+        await read_body()
+        if method == 'GET' and url.path == '/health':
+            return 200, {'status': 'ok', 'traditions': sorted(self.spd_models), 'pending': self.pending}
+        if method == 'GET' and url.path == '/metrics':
+            return 200, self.get_metrics()
+        return 404, {'error': 'not found'}
+
+    async def handle(self, reader, writer):
+        unread = 0
+
+        async def read_body():
+            nonlocal unread
+            length, unread = unread, 0
+            return await reader.readexactly(length) if length else b''
+
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if len(request_line) < 2:
+                status, payload = 400, {'error': 'bad request line'}
+            elif length > self.max_body:
+                status, payload = 413, {'error': 'body over {} bytes'.format(self.max_body)}
+            else:
+                unread = length
+                status, payload = await self.route(request_line[0], request_line[1], headers, read_body)
+        except Exception as e:
+            status, payload = 400, {'error': '{}: {}'.format(type(e).__name__, e)}
+
+        data = json.dumps(payload).encode()
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, REASONS[status], len(data)).encode() + data)
+        try:
+            await writer.drain()
+            if status == 503:
+                # the rejected upload is discarded after the response so the client can read it, never buffered
+                while unread > 0:
+                    chunk = await reader.read(min(unread, 1 << 16))
+                    if not chunk:
+                        break
+                    unread -= len(chunk)
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8750, socket_path=None):
+        self.start_batchers()
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle, socket_path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        print('Serving on {}'.format(socket_path or '{}:{}'.format(host, port)))
+        async with server:
+            await server.serve_forever()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(method, path, body=None, headers=None, host='127.0.0.1', port=8750, socket_path=None, timeout=None):
+    """
+    Local client, returns (status, decoded json)
+    """
+    if socket_path:
+        conn = UnixHTTPConnection(socket_path, timeout)
+    else:
+        conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read().decode())
+    finally:
+        conn.close()
+
+
+def predict_remote(file_path, tradition='h', tonic=None, send_path=False, **kwargs):
+    """
+    Upload file_path to a running server, or with send_path only send its path to be read by the server
+    """
+    if send_path:
+        body = json.dumps({'path': os.path.abspath(file_path), 'tradition': tradition, 'tonic': tonic})
+        return request('POST', '/predict', body, {'Content-Type': 'application/json'}, **kwargs)
+    ext = os.path.splitext(file_path)[1].lower().lstrip('.')
+    query = {'tradition': tradition, 'format': ext}
+    if tonic:
+        query['tonic'] = tonic
+    with open(file_path, 'rb') as f:
+        body = f.read()
+    content_type = 'audio/mpeg' if ext == 'mp3' else 'audio/wav'
+    return request('POST', '/predict?' + urlencode(query), body, {'Content-Type': content_type}, **kwargs)
+
+
+def serve(host='127.0.0.1', port=8750, socket_path=None, traditions=('Hindustani', 'Carnatic'), **kwargs):
+    from core import get_crepe, get_spd_model, preload_models
+    for tradition in traditions:
+        preload_models(tradition, background=False)
+    server = InferenceServer(get_crepe(), {t: get_spd_model(t) for t in traditions}, **kwargs)
+    asyncio.run(server.serve(host, port, socket_path))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('command', choices=['serve', 'predict', 'health', 'metrics'],
+                            help='runs the server or sends a request to a running one')
+    arg_parser.add_argument('file', nargs='?', default=None,
+                            help='audio file to predict')
+    arg_parser.add_argument('--host', default='127.0.0.1',
+                            help='sets the address the server listens on')
+    arg_parser.add_argument('--port', default=8750,
+                            help='sets the port the server listens on')
+    arg_parser.add_argument('--socket', default=None,
+                            help='listens on / connects to this unix socket instead of host and port')
+    arg_parser.add_argument('--window', default=0.02,
+                            help='sets the micro-batching window in seconds')
+    arg_parser.add_argument('--max_pending', default=32,
+                            help='sets the number of admitted requests, further ones get 503')
+    arg_parser.add_argument('--tradition', default='h',
+                            help='sets the tradition - [h]industani/[c]arnatic')
+    arg_parser.add_argument('--tonic', default=None,
+                            help='sets the tonic if given, otherwise tonic is predicted')
+    arg_parser.add_argument('--send_path', default=False,
+                            help='sends the file path instead of uploading the audio')
+    p_args = arg_parser.parse_args()
+
+    connection = {'host': p_args.host, 'port': int(p_args.port), 'socket_path': p_args.socket}
+    if p_args.command == 'serve':
+        serve(window=float(p_args.window), max_pending=int(p_args.max_pending), **connection)
+    elif p_args.command == 'predict':
+        print(predict_remote(p_args.file, p_args.tradition, p_args.tonic, bool(p_args.send_path), **connection))
+    else:
+        print(request('GET', '/' + p_args.command, **connection))
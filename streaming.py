@@ -0,0 +1,161 @@
+import numpy as np
+import data_utils
+import raga_feature
+
+
+class StreamingSPD:
+    """
+    Incremental version of raga_feature.generate_full_spd_cache for a growing pitch matrix
+
+    Rows are the stretched, tonic-rolled 120-bin pitch values. A run of equal notes is
+    only folded into the SPD once the next run starts, so every update costs O(new rows).
+    For each start note and direction the state is the open segment of full_spd_np: the
+    prefix sum at the last start note and the largest note offset seen since, a new
+    maximum closes a span from that start note to the current note.
+    """
+
+    def __init__(self, n_bins=120):
+        self.n_bins = n_bins
+        self.n_frames = 0
+        self.total = np.zeros(n_bins)
+        self.spd_sum = np.zeros([12, 12, n_bins, 2])
+        self.span_closed = np.zeros([12, 12, 2], dtype=bool)
+        self.seg_active = np.zeros([2, 12], dtype=bool)
+        self.seg_max = np.zeros([2, 12], dtype=np.int64)
+        self.seg_cum = np.zeros([2, 12, n_bins])
+        self.run_note = None
+        self.run_cum = np.zeros(n_bins)
+
+    def get_offsets(self, note):
+        ps = np.arange(12)
+        return np.stack([(note - ps) % 12, (ps - note) % 12])
+
+    def close_run(self):
+        note = self.run_note
+        offsets = self.get_offsets(note)
+        for asc_int in range(2):
+            is_end = self.seg_active[asc_int] & (offsets[asc_int] > self.seg_max[asc_int])
+            is_end[note] = False
+            for s in np.flatnonzero(is_end):
+                self.spd_sum[s, note, :, asc_int] += self.total - self.seg_cum[asc_int, s]
+                self.span_closed[s, note, asc_int] = True
+                self.seg_max[asc_int, s] = offsets[asc_int, s]
+            self.seg_active[asc_int, note] = True
+            self.seg_max[asc_int, note] = 0
+            self.seg_cum[asc_int, note] = self.run_cum
+
+    def update(self, pitchvalue_prob):
+        notes = np.argmax(pitchvalue_prob, axis=1) // 10
+        run_starts = np.concatenate([[0], np.flatnonzero(np.diff(notes)) + 1, [len(notes)]])
+        for i in range(len(run_starts) - 1):
+            note = notes[run_starts[i]]
+            if note != self.run_note:
+                if self.run_note is not None:
+                    self.close_run()
+                self.run_note = note
+                self.run_cum = self.total.copy()
+            self.total += np.sum(pitchvalue_prob[run_starts[i]:run_starts[i + 1]], axis=0)
+        self.n_frames += len(notes)
+
+    def get_spd_cache(self):
+        """
+        Returns (full_spd_dist, dist_hist) of all rows seen so far, as generate_full_spd_cache would
+        """
+        spd_sum = self.spd_sum.copy()
+        # spans ending on the still open last run
+        if self.run_note is not None:
+            note = self.run_note
+            offsets = self.get_offsets(note)
+            for asc_int in range(2):
+                is_end = self.seg_active[asc_int] & (offsets[asc_int] > self.seg_max[asc_int])
+                is_end[note] = False
+                for s in np.flatnonzero(is_end):
+                    spd_sum[s, note, :, asc_int] += self.total - self.seg_cum[asc_int, s]
+        # whole clip fallback of compute_spd_ps_pe
+        spd_sum += (~self.span_closed)[:, :, np.newaxis, :] * self.total[:, np.newaxis]
+
+        dist_hist = raga_feature.normalize(self.total)
+        full_spd_dist = np.zeros([12, 12, self.n_bins, 2])
+        for asc_int in range(2):
+            for s in range(12):
+                for e in range(12):
+                    dist = raga_feature.normalize(spd_sum[s, e, :, asc_int])
+                    if s == e or np.sum(dist) == 0:
+                        full_spd_dist[s, e, :, asc_int] = dist_hist
+                    else:
+                        full_spd_dist[s, e, :, asc_int] = dist
+        return full_spd_dist, dist_hist
+
+
+class StreamingRagaPredictor:
+    """
+    Live raga/tonic estimate over a growing recording
+
+    Audio blocks are framed and run through CRePE as they arrive, only the new frames
+    are predicted. The tonic is given or predicted once from the first tonic_warmup
+    seconds and then kept, since the SPD depends on the tonic roll of the pitch values.
+    The raga is re-estimated every refresh_interval seconds of audio.
+    """
+
+    def __init__(self, crepe, spd_model, tonic=None, tonic_warmup=30, refresh_interval=5):
+        self.crepe = crepe
+        self.spd_model = spd_model
+        self.model_srate = crepe.pitch_config['model_srate']
+        self.hop_length = int(self.model_srate * crepe.pitch_config['hop_size'])
+        self.tonic_warmup = tonic_warmup
+        self.refresh_interval = refresh_interval
+        self.spd = StreamingSPD()
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.warmup_audio = []
+        self.warmup_pitches = []
+        self.n_samples = 0
+        self.last_refresh = 0
+        self.tonic_12 = None
+        self.tonic = None
+        self.pred_raga = None
+        if tonic is not None:
+            self.tonic_12, self.tonic = spd_model.get_tonic_from_name(tonic)
+
+    def add_pitches(self, pitches):
+        pitchvalue_prob = self.crepe.stretch(pitches)
+        pitchvalue_prob = np.roll(pitchvalue_prob, -self.tonic * 2, axis=1)
+        self.spd.update(pitchvalue_prob)
+
+    def feed(self, audio):
+        """
+        Add a block of 16 kHz audio, returns (tonic_12, pred_raga) when the estimate was refreshed
+        """
+        self.n_samples += len(audio)
+        self.buffer = np.concatenate([self.buffer, audio])
+        if self.tonic is None:
+            self.warmup_audio.append(audio)
+
+        if len(self.buffer) >= 1024:
+            frames = data_utils.audio_2_frames(self.buffer, self.crepe.pitch_config)
+            self.buffer = self.buffer[len(frames) * self.hop_length:]
+            pitches = self.crepe.predict_frames(frames)
+            if self.tonic is None:
+                self.warmup_pitches.append(pitches)
+            else:
+                self.add_pitches(pitches)
+
+        if self.tonic is None and self.warmup_pitches and \
+                self.n_samples >= self.tonic_warmup * self.model_srate:
+            audio = np.concatenate(self.warmup_audio)
+            pitches = np.concatenate(self.warmup_pitches)
+            self.tonic_12, self.tonic = self.spd_model.predict_tonic(audio, pitches)
+            self.add_pitches(pitches)
+            self.warmup_audio = []
+            self.warmup_pitches = []
+
+        if self.tonic is not None and self.spd.n_frames > 0 and \
+                self.n_samples - self.last_refresh >= self.refresh_interval * self.model_srate:
+            self.last_refresh = self.n_samples
+            return self.refresh()
+        return None
+
+    def refresh(self):
+        spd_cache = self.spd.get_spd_cache()
+        pred_proba = self.spd_model.predict_raga_proba([spd_cache])
+        self.pred_raga = self.spd_model.get_raga_from_proba(pred_proba[0])
+        return self.tonic_12, self.pred_raga
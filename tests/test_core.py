@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+import core
+
+
+def test_stretch_rows():
+    pitches = np.random.RandomState(0).rand(300, 60).astype(np.float32)
+    # stretch and interp1d use no model state
+    stretched = core.CRePE.stretch(None, pitches)
+    assert np.array_equal(stretched, [core.CRePE.interp1d(None, p, 60, 120) for p in pitches])
+
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        core.CRePE(backend='onnx')
@@ -0,0 +1,96 @@
+import glob
+import numpy as np
+import pytest
+from scipy.io import wavfile
+from scipy.signal import resample_poly
+import data_utils
+
+SAMPLE_DIR = 'data/sample_data'
+PITCH_CONFIG = {'hop_size': 0.01}
+
+
+def split_blocks(audio, sizes):
+    blocks = []
+    i = 0
+    for size in sizes:
+        blocks.append(audio[i:i + size])
+        i += size
+    return blocks + [audio[i:]]
+
+
+@pytest.mark.parametrize('sizes', [[16000] * 4, [100, 1023, 1, 5000, 333], [1024, 160, 160, 7]])
+def test_blocks_2_frame_chunks(sizes):
+    audio = np.random.RandomState(0).randn(70000).astype(np.float32)
+    frames = np.concatenate(list(data_utils.blocks_2_frame_chunks(split_blocks(audio, sizes), PITCH_CONFIG, 500)))
+    assert np.array_equal(frames, data_utils.audio_2_frames(audio, PITCH_CONFIG))
+
+
+@pytest.mark.parametrize('sr', [16000, 22050, 44100, 48000, 8000])
+@pytest.mark.parametrize('channels', [1, 2])
+def test_iter_wav_blocks(tmp_path, sr, channels):
+    audio = np.random.RandomState(sr).randn(int(sr * 2.3), channels).astype(np.float32) * 0.1
+    path = str(tmp_path / 'clip.wav')
+    wavfile.write(path, sr, audio[:, 0] if channels == 1 else audio)
+    blocks = list(data_utils.iter_wav_blocks(path, block_size=sr // 3))
+    assert len(blocks) > 1
+    ref = audio.mean(1)
+    if sr != 16000:
+        ref = resample_poly(ref, 16000 // np.gcd(sr, 16000), sr // np.gcd(sr, 16000))
+    out = np.concatenate(blocks)
+    assert len(out) == len(ref)
+    assert np.max(np.abs(out - ref)) < 1e-6
+
+
+def fold_cqt_db(C):
+    librosa = pytest.importorskip('librosa')
+    c_db = librosa.amplitude_to_db(C, ref=np.max)
+    return np.transpose(np.mean(np.reshape(c_db, [7, 60, -1]), axis=0))
+
+
+@pytest.mark.parametrize('file_path', sorted(glob.glob(SAMPLE_DIR + '/*.wav')))
+def test_get_cqt_fast_matches_librosa(file_path):
+    # get_cqt pads with 'wrap', which librosa >= 0.10 rejects, so the reference pads with zeros
+    # and only frames at least half the lowest octave's window (8.2 s) from the edges are compared
+    librosa = pytest.importorskip('librosa')
+    audio = data_utils.load_audio(file_path)[:16000 * 30]
+    C = np.abs(librosa.cqt(audio, sr=16000, bins_per_octave=60, n_bins=60 * 7, pad_mode='constant',
+                           fmin=librosa.note_to_hz('C1')))
+    ref = fold_cqt_db(C)[130:-130]
+    c_cqt = data_utils.get_cqt_fast(audio)[0][130:-130]
+    # single bins can differ by a few dB where the per-octave resamplers differ, the tonic
+    # model only sees the mean and std over time
+    assert np.percentile(np.abs(c_cqt - ref), 99) < 2.0
+    assert np.max(np.abs(np.mean(c_cqt, 0) - np.mean(ref, 0))) < 0.25
+    assert np.max(np.abs(np.std(c_cqt, 0) - np.std(ref, 0))) < 0.25
+
+
+def test_get_cqt_fast_matches_get_cqt():
+    librosa = pytest.importorskip('librosa')
+    audio = data_utils.load_audio(sorted(glob.glob(SAMPLE_DIR + '/*.wav'))[0])[:16000 * 30]
+    try:
+        ref = data_utils.get_cqt(audio)[0]
+    except librosa.util.exceptions.ParameterError:
+        pytest.skip('librosa {} has no wrap padding'.format(librosa.__version__))
+    c_cqt = data_utils.get_cqt_fast(audio)[0]
+    assert c_cqt.shape == ref.shape
+    assert np.max(np.abs(np.mean(c_cqt, 0) - np.mean(ref, 0))) < 0.25
+    assert np.max(np.abs(np.std(c_cqt, 0) - np.std(ref, 0))) < 0.25
+
+
+@pytest.mark.parametrize('stride', [1, 4])
+def test_get_cqt_stats(stride):
+    audio = np.random.RandomState(0).randn(16000 * 20).astype(np.float32)
+    c_cqt = data_utils.get_cqt_fast(audio, stride=stride, block_frames=100)[0]
+    cqt_mean, cqt_std = data_utils.get_cqt_stats(audio, stride=stride, block_frames=100)
+    assert np.allclose(cqt_mean, np.mean(c_cqt, 0), atol=1e-4)
+    assert np.allclose(cqt_std, np.std(c_cqt, 0), atol=1e-4)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_to_local_average_cents_rows(seed):
+    rng = np.random.RandomState(seed)
+    salience = rng.rand(200, 360)
+    # peaks at and next to both edges, where the 9 bin window is cut short
+    salience[0, 0] = salience[1, 2] = salience[2, 359] = salience[3, 355] = 2
+    cents = data_utils.to_local_average_cents(salience)
+    assert np.allclose(cents, [data_utils.to_local_average_cents(row) for row in salience], rtol=0, atol=1e-9)
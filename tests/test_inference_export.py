@@ -0,0 +1,142 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+import inference_export
+
+
+class DenseSigmoid:
+    """
+    numpy reference with the predict interface of a keras model
+    """
+
+    def __init__(self, w, b):
+        self.w = w
+        self.b = b
+
+    def predict(self, x, batch_size=32):
+        return 1 / (1 + np.exp(-(np.matmul(x, self.w) + self.b)))
+
+
+@pytest.fixture
+def frozen_dense(tmp_path):
+    rng = np.random.RandomState(0)
+    w = rng.randn(16, 8).astype(np.float32)
+    b = rng.randn(8).astype(np.float32)
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.compat.v1.placeholder(tf.float32, [None, 16], name='x_input')
+        tf.sigmoid(tf.matmul(x, w) + b, name='pitch')
+    path = str(tmp_path / 'dense.pb')
+    inference_export.save_graph(graph.as_graph_def(), path)
+    return inference_export.FrozenModel(path, 'x_input', 'pitch'), w, b
+
+
+def test_check_max_diff_within_tolerance(frozen_dense):
+    frozen_model, w, b = frozen_dense
+    x = np.random.RandomState(1).randn(100, 16).astype(np.float32)
+    diff = inference_export.check_max_diff('dense', DenseSigmoid(w, b), frozen_model, x, 1e-4)
+    assert diff <= 1e-4
+
+
+def test_check_max_diff_above_tolerance(frozen_dense):
+    frozen_model, w, b = frozen_dense
+    x = np.random.RandomState(1).randn(100, 16).astype(np.float32)
+    with pytest.raises(ValueError):
+        inference_export.check_max_diff('dense', DenseSigmoid(w, b + 0.5), frozen_model, x, 1e-4)
+
+
+def test_check_max_diff_nan(frozen_dense):
+    frozen_model, w, b = frozen_dense
+    x = np.random.RandomState(1).randn(100, 16).astype(np.float32)
+    with pytest.raises(ValueError):
+        inference_export.check_max_diff('dense', DenseSigmoid(w, b * np.nan), frozen_model, x, 1e-4)
+
+
+def randomize_bn(model, rng):
+    # non-trivial moving statistics, so a wrong scale or shift shows in the output
+    for bn in inference_export.get_layers(model, tf.keras.layers.BatchNormalization):
+        dim = bn.get_weights()[0].shape[0]
+        bn.set_weights([rng.uniform(0.5, 1.5, dim), rng.randn(dim) * 0.1, rng.randn(dim) * 0.1,
+                        rng.uniform(0.5, 1.5, dim)])
+
+
+def get_pitch_model(rng):
+    """
+    The layers of CRePE.get_pitch_emb with fewer filters
+    """
+    layers = tf.keras.layers
+    x_input = layers.Input(shape=(1024,), name='x_input')
+    y = layers.Reshape(target_shape=(1024, 1, 1), name='input-reshape')(x_input)
+    for l, f, w, s in zip(range(1, 7), [16, 2, 2, 2, 4, 8], [512, 64, 64, 64, 64, 64], [(4, 1)] + [(1, 1)] * 5):
+        y = layers.Conv2D(f, (w, 1), strides=s, padding='same', activation='relu', name='conv%d' % l)(y)
+        y = layers.BatchNormalization(name='conv%d-BN' % l)(y)
+        y = layers.MaxPool2D(pool_size=(2, 1), padding='valid', name='conv%d-maxpool' % l)(y)
+        y = layers.Dropout(0.25, name='conv%d-dropout' % l)(y)
+    y = layers.Permute((2, 1, 3))(y)
+    y = layers.Flatten(name='flatten')(y)
+    y = layers.Dense(360, activation='sigmoid', name='classifier')(y)
+    model = tf.keras.Model(inputs=[x_input], outputs=y)
+    randomize_bn(model, rng)
+    return model
+
+
+def get_tonic_model(rng, f=8, note_dim=16):
+    """
+    The layers of SPD_Model.get_rotated_hist_emb and the tonic Dense with fewer filters, on the rolled histograms
+    """
+    layers = tf.keras.layers
+    hist_input = layers.Input(shape=(60, 4), name='hist_cqt_input')
+    z = hist_input
+    for ks, n in [(5, f), (3, 2 * f), (3, 4 * f)]:
+        z = layers.Conv1D(filters=n, kernel_size=ks, padding='same', activation='relu')(z)
+        z = layers.Conv1D(filters=n, kernel_size=ks, padding='same', activation='relu')(z)
+        z = layers.BatchNormalization()(z)
+        z = layers.MaxPool1D(pool_size=2)(z)
+    z = layers.Flatten()(z)
+    z = layers.Dense(note_dim, activation='relu')(z)
+    z = layers.Dense(60, activation='sigmoid')(z)
+    model = tf.keras.Model(inputs=[hist_input], outputs=z)
+    randomize_bn(model, rng)
+    return model
+
+
+class RolledTonicModel:
+    """
+    get_tonic_emb_batch around a model of the rolled histograms, done in numpy
+    """
+
+    def __init__(self, model, roll_idx, unroll):
+        self.model = model
+        self.roll_idx = roll_idx
+        self.unroll = unroll
+
+    def predict(self, x, batch_size=32):
+        logits = self.model.predict(np.reshape(x[:, self.roll_idx], [-1, 60, 4]), batch_size=batch_size, verbose=0)
+        return np.einsum('nri,rij->nj', np.reshape(logits, [len(x), len(self.roll_idx), 60]), self.unroll)
+
+
+def test_pitch_graph_matches_keras(tmp_path):
+    rng = np.random.RandomState(0)
+    model = get_pitch_model(rng)
+    path = str(tmp_path / 'pitch.pb')
+    inference_export.save_graph(inference_export.build_pitch_graph(model), path)
+    frozen_model = inference_export.FrozenModel(path, 'x_input', 'pitch')
+    x = rng.randn(64, 1024).astype(np.float32)
+    assert inference_export.check_max_diff('pitch', model, frozen_model, x, 1e-4) <= 1e-4
+
+
+def test_tonic_graph_matches_keras(tmp_path):
+    rng = np.random.RandomState(0)
+    rotations = np.array([0, 7, 20, 33, 46])
+    roll_idx = (np.arange(60)[np.newaxis, :] + rotations[:, np.newaxis]) % 60
+    unroll = np.zeros([len(rotations), 60, 60], dtype=np.float32)
+    for i in range(len(rotations)):
+        unroll[i, np.arange(60), roll_idx[i]] = 1.0 / len(rotations)
+    model = get_tonic_model(rng)
+    path = str(tmp_path / 'tonic.pb')
+    inference_export.save_graph(inference_export.build_tonic_graph(model, roll_idx, unroll), path)
+    frozen_model = inference_export.FrozenModel(path, 'hist_cqt_input', 'tonic')
+    x = rng.rand(16, 60, 4).astype(np.float32)
+    reference = RolledTonicModel(model, roll_idx, unroll)
+    assert inference_export.check_max_diff('tonic', reference, frozen_model, x, 1e-4) <= 1e-4
@@ -0,0 +1,72 @@
+import math
+import pickle
+import numpy as np
+import pytest
+import knn_index
+
+sklearn_neighbors = pytest.importorskip('sklearn.neighbors')
+
+
+def bhatta(hist1, hist2):
+    # SPDKNN.bhatta, clipped at 0 as rounding can take 1 - t * score below it for equal rows
+    score = np.sum(np.sqrt(np.multiply(hist1, hist2)))
+    t = 1 / math.sqrt(np.mean(hist1) * np.mean(hist2) * len(hist1) * len(hist2))
+    return math.sqrt(max(1 - t * score, 0))
+
+
+class SPDKNN:
+    # the interface of main.SPDKNN, which is what the pickled models hold
+    def __init__(self, knn):
+        self.knn = knn
+
+    def predict(self, X):
+        return self.knn.predict_proba(X)
+
+
+def get_spd_knn(rng, n_train=60, dim=24, n_classes=4, k=5):
+    X = rng.dirichlet(np.ones(dim), n_train)
+    y = rng.integers(0, n_classes, n_train)
+    knn = sklearn_neighbors.KNeighborsClassifier(n_neighbors=k, algorithm='ball_tree', metric=bhatta)
+    return SPDKNN(knn.fit(X, y)), X, y
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_hellinger_knn_matches_bhatta_knn(seed):
+    rng = np.random.default_rng(seed)
+    spd_knn, X, y = get_spd_knn(rng)
+    hknn = knn_index.HellingerKNN(5).fit(X, y)
+    X_query = rng.dirichlet(np.ones(X.shape[1]), 30)
+    assert np.array_equal(hknn.predict(X_query), spd_knn.predict(X_query))
+    neigh_idx = spd_knn.knn.kneighbors(X_query, return_distance=False)
+    assert all(set(a) == set(b) for a, b in zip(hknn.kneighbors(X_query), neigh_idx))
+
+
+def test_from_spd_knn_matches_on_mixed_queries():
+    rng = np.random.default_rng(0)
+    spd_knn, X, _ = get_spd_knn(rng)
+    hknn = knn_index.HellingerKNN.from_spd_knn(spd_knn)
+    X_check = knn_index.get_check_queries(X, 50)
+    assert not any(np.any(np.all(np.isclose(x, X), axis=1)) for x in X_check)
+    assert knn_index.check_proba_diff('test', hknn, spd_knn, X_check, 1e-6) == 0
+
+
+def test_check_proba_diff_above_tolerance():
+    rng = np.random.default_rng(0)
+    spd_knn, X, y = get_spd_knn(rng)
+    hknn = knn_index.HellingerKNN(5).fit(X, np.roll(y, 1))
+    with pytest.raises(ValueError):
+        knn_index.check_proba_diff('test', hknn, spd_knn, knn_index.get_check_queries(X, 50), 1e-6)
+
+
+def test_convert_and_migrate(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    model_dir = tmp_path / 'data/RagaDataset/Hindustani/model'
+    model_dir.mkdir(parents=True)
+    for wd in range(0, 250, 10):
+        with open(knn_index.get_knn_path('Hindustani', wd, 'pkl'), 'wb') as f:
+            pickle.dump(get_spd_knn(rng, n_train=30)[0], f)
+    knn_index.convert_spd_knn_models('Hindustani')
+    knn_index.migrate_knn_store('Hindustani', 'float16')
+    for wd in [0, 240]:
+        assert isinstance(knn_index.load_knn_model('Hindustani', wd), knn_index.HellingerKNN)
@@ -0,0 +1,59 @@
+import numpy as np
+from scipy.io import wavfile
+import data_utils
+import raga_feature
+import streaming
+import live
+
+
+class StubCRePE:
+    """
+    predict_frames and stretch of CRePE, the pitch of a frame is the argmax of its first 120 samples
+    """
+
+    def __init__(self):
+        self.pitch_config = {'model_srate': 16000, 'hop_size': 0.01}
+        self.n_frames = 0
+
+    def predict_frames(self, frames):
+        self.n_frames += len(frames)
+        return np.eye(120)[np.argmax(frames[:, :120], axis=1)] * 0.9 + 0.001
+
+    def stretch(self, pitches):
+        return pitches
+
+
+class StubSPDModel:
+    def __init__(self):
+        self.spd_caches = []
+
+    def get_tonic_from_name(self, tonic):
+        return tonic, 0
+
+    def predict_raga_proba(self, spd_caches):
+        self.spd_caches.extend(spd_caches)
+        return [np.zeros(2) for _ in spd_caches]
+
+    def get_raga_from_proba(self, pred_proba):
+        return 'raga_{}'.format(len(self.spd_caches))
+
+
+def test_live_session_file_source(tmp_path):
+    path = str(tmp_path / 'clip.wav')
+    audio = np.random.RandomState(0).randn(12 * 16000).astype(np.float32)
+    wavfile.write(path, 16000, audio)
+    crepe = StubCRePE()
+    spd_model = StubSPDModel()
+    predictor = streaming.StreamingRagaPredictor(crepe, spd_model, tonic='C')
+    session = live.LiveSession(predictor, live.FileSource(path, realtime=False), window=2, buffer_seconds=4)
+    session.start()
+    session.join(30)
+    session.stop()
+
+    assert session.results == [('C', 'raga_{}'.format(i)) for i in range(1, 7)]
+    assert session.ring.n_dropped == 0
+    frames = data_utils.audio_2_frames(audio, crepe.pitch_config)
+    assert crepe.n_frames == len(frames)
+    full_spd_dist, dist_hist = raga_feature.generate_full_spd_cache(crepe.predict_frames(frames))
+    assert np.allclose(spd_model.spd_caches[-1][0], full_spd_dist)
+    assert np.allclose(spd_model.spd_caches[-1][1], dist_hist)
@@ -0,0 +1,149 @@
+import os
+import time
+import socket
+import asyncio
+import tempfile
+import threading
+import numpy as np
+import pytest
+from scipy.io import wavfile
+import server
+
+
+class StubCRePE:
+    """
+    predict_frames of CRePE, a batch waits until release is set and takes delay seconds
+    """
+
+    def __init__(self, delay=0.1):
+        self.pitch_config = {'hop_size': 0.01, 'vad': False}
+        self.delay = delay
+        self.release = threading.Event()
+        self.release.set()
+        self.batch_sizes = []
+
+    def predict_frames(self, frames):
+        self.release.wait()
+        time.sleep(self.delay)
+        self.batch_sizes.append(len(frames))
+        return np.zeros([len(frames), 60], dtype=np.float32)
+
+
+class StubSPDModel:
+    """
+    The SPD_Model methods used by InferenceServer.predict when the tonic is given
+    """
+
+    def get_tonic_from_name(self, tonic):
+        return tonic, 0
+
+    def get_spd_cache(self, crepe, pitches, tonic_idx):
+        return len(pitches)
+
+    def predict_raga_proba(self, spd_caches):
+        return [np.array([n_frames, 1.0]) for n_frames in spd_caches]
+
+    def get_raga_from_proba(self, pred_proba):
+        return 'raga_{}'.format(int(pred_proba[0]))
+
+
+async def cancel_tasks():
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.fixture
+def running_server():
+    socket_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(socket_dir, 'server.sock')
+    crepe = StubCRePE()
+    inference_server = server.InferenceServer(crepe, {'Hindustani': StubSPDModel()}, window=0.2, max_pending=4,
+                                              cpu_threads=4)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(inference_server.serve(socket_path=socket_path), loop)
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.05)
+    yield inference_server, crepe, socket_path
+    crepe.release.set()
+    asyncio.run_coroutine_threadsafe(cancel_tasks(), loop).result(5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+    os.remove(socket_path)
+    os.rmdir(socket_dir)
+
+
+@pytest.fixture
+def wav_path(tmp_path):
+    path = str(tmp_path / 'clip.wav')
+    wavfile.write(path, 16000, np.random.RandomState(0).randn(16000).astype(np.float32) * 0.1)
+    return path
+
+
+def predict_concurrently(wav_path, socket_path, n):
+    results = [None] * n
+
+    def run(i):
+        results[i] = server.predict_remote(wav_path, 'h', 'C', socket_path=socket_path, timeout=30)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_predict_remote_round_trip(running_server, wav_path):
+    inference_server, crepe, socket_path = running_server
+    status, payload = server.predict_remote(wav_path, 'h', 'C', socket_path=socket_path, timeout=30)
+    assert status == 200
+    n_frames = 1 + (16000 - 1024) // 160
+    assert payload['raga'] == 'raga_{}'.format(n_frames)
+    assert payload['tonic'] == 'C'
+    assert payload['tradition'] == 'Hindustani'
+    assert payload['audio_seconds'] == 1.0
+    assert server.request('GET', '/health', socket_path=socket_path)[1]['status'] == 'ok'
+
+
+def test_concurrent_requests_are_micro_batched(running_server, wav_path):
+    inference_server, crepe, socket_path = running_server
+    results = predict_concurrently(wav_path, socket_path, 4)
+    assert [status for status, _ in results] == [200] * 4
+    stats = inference_server.batchers['pitch'].stats()
+    assert stats['items'] == 4
+    assert stats['batches'] < 4
+    assert max(crepe.batch_sizes) > 1 + (16000 - 1024) // 160
+
+
+def test_rejected_before_body_is_read(running_server, wav_path):
+    inference_server, crepe, socket_path = running_server
+    crepe.release.clear()
+    blocked = threading.Thread(target=predict_concurrently, args=(wav_path, socket_path, 4))
+    blocked.start()
+    for _ in range(100):
+        if inference_server.pending == inference_server.max_pending:
+            break
+        time.sleep(0.05)
+    assert inference_server.pending == inference_server.max_pending
+
+    # only the headers are sent, a server reading the body first would never answer
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5)
+    sock.connect(socket_path)
+    sock.sendall(b'POST /predict?tradition=h HTTP/1.1\r\nContent-Type: audio/wav\r\n'
+                 b'Content-Length: 10000000\r\n\r\n')
+    response = sock.recv(4096)
+    sock.close()
+    assert response.startswith(b'HTTP/1.1 503')
+    assert inference_server.counts['rejected'] == 1
+
+    crepe.release.set()
+    blocked.join(30)
+    assert inference_server.counts['completed'] == 4
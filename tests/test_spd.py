@@ -0,0 +1,114 @@
+import glob
+import numpy as np
+import pytest
+import raga_feature
+
+SAMPLE_DIR = 'data/sample_data'
+
+
+def get_random_walk(rng, n):
+    # pitch argmax bins 0..119 moving by small steps, like a sung melody
+    return np.cumsum(rng.integers(-7, 8, n)) % 120
+
+
+def get_sample_pitches_arg(file_path):
+    # the CQT argmax stands in for the CRePE argmax, the pitch model weights are not bundled
+    data_utils = pytest.importorskip('data_utils')
+    audio = data_utils.load_audio(file_path)
+    cqt = data_utils.get_cqt_fast(audio)[0]
+    return 2 * np.argmax(cqt, axis=1)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_full_spd_np_random(seed):
+    rng = np.random.default_rng(seed)
+    pitches_arg = rng.integers(0, 120, 500)
+    assert raga_feature.check_spd_equivalence(pitches_arg)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_full_spd_np_random_walk(seed):
+    rng = np.random.default_rng(seed)
+    pitches_arg = get_random_walk(rng, 3000)
+    # the reference full_spd needs every note to occur
+    assert len(np.unique(pitches_arg // 10)) == 12
+    assert raga_feature.check_spd_equivalence(pitches_arg)
+
+
+@pytest.mark.parametrize('file_path', sorted(glob.glob(SAMPLE_DIR + '/*.wav')))
+def test_full_spd_np_sample_clips(file_path):
+    pitches_arg = get_sample_pitches_arg(file_path)
+    if len(np.unique(pitches_arg // 10)) < 12:
+        pytest.skip('not every note occurs in {}'.format(file_path))
+    assert raga_feature.check_spd_equivalence(pitches_arg)
+
+
+def test_full_spd_np_missing_note():
+    # note 5 never occurs, full_spd indexes its empty start list
+    rng = np.random.default_rng(0)
+    pitches_arg = get_random_walk(rng, 2000)
+    pitches_arg = pitches_arg[pitches_arg // 10 != 5]
+    with pytest.raises(IndexError):
+        raga_feature.full_spd(pitches_arg, {})
+
+    lm_file = {}
+    raga_feature.full_spd_np(pitches_arg, lm_file)
+    n = len(pitches_arg)
+    run_ends = np.flatnonzero(np.diff(pitches_arg // 10))
+    whole_clip = (0, int(run_ends[0]), int(run_ends[-1]) + 1, n - 1)
+    for asc in [True, False]:
+        for e in range(12):
+            if e != 5:
+                assert lm_file['5_{}_{}'.format(e, asc)] == [whole_clip]
+    assert len(lm_file) == 2 * 12 * 11
+
+
+@pytest.mark.parametrize('wd', range(0, 250, 10))
+def test_raga_feat_wd_gather(wd):
+    rng = np.random.default_rng(wd)
+    full_spd_dist = rng.random([12, 12, 120, 2])
+    dist_hist = rng.random(120)
+    feat = raga_feature.get_raga_feat_wd(full_spd_dist, dist_hist, wd)
+    assert np.array_equal(feat, raga_feature.get_raga_feat_wd_ref(full_spd_dist, dist_hist, wd))
+
+
+class StubKNN:
+    # predict_proba from a fixed projection of the features, so every feature value counts
+    def __init__(self, dim, n_labels, seed):
+        self.W = np.random.default_rng(seed).random([dim, n_labels])
+
+    def predict(self, X):
+        return np.matmul(X, self.W)
+
+
+def test_raga_feat_and_predict_batch():
+    rng = np.random.default_rng(0)
+    n_labels = 4
+    pitches = [np.eye(120)[get_random_walk(rng, 1500)] + 0.01 * rng.random([1500, 120]) for _ in range(3)]
+    spd_caches = [raga_feature.generate_full_spd_cache(pitchvalue_prob) for pitchvalue_prob in pitches]
+    knn_models = {wd: StubKNN(len(raga_feature.get_raga_feat_wd(*spd_caches[0], wd)), n_labels, wd)
+                  for wd in range(0, 250, 10)}
+    pred_proba = raga_feature.get_raga_feat_and_predict_batch(knn_models, spd_caches, n_labels)
+    for i, pitchvalue_prob in enumerate(pitches):
+        assert np.allclose(raga_feature.get_raga_feat_and_predict(knn_models, pitchvalue_prob, n_labels),
+                           pred_proba[i])
+
+
+def get_random_spans(rng, n, n_spans):
+    # (i1, i2, i3, i4) with i1 <= i2 <= i3 <= i4 like the entries of full_spd_np
+    return [tuple(int(i) for i in np.sort(rng.integers(0, n, 4))) for _ in range(n_spans)]
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_prefix_sum_dists(seed):
+    rng = np.random.default_rng(seed)
+    pitchvalue_prob = rng.random([500, 120])
+    cum_dist = raga_feature.get_cum_dist(pitchvalue_prob)
+    for start_idx, _, _, end_idx in get_random_spans(rng, 500, 20):
+        assert np.allclose(raga_feature.get_dist_btw_idx_cum(cum_dist, start_idx, end_idx),
+                           raga_feature.get_dist_btw_idx(pitchvalue_prob, start_idx, end_idx))
+    shortlisted_idxs = get_random_spans(rng, 500, 30)
+    for off_start, off_end in [(0, None), (100, 400), (250, 260)]:
+        assert np.allclose(
+            raga_feature.get_dist_btw_shortlisted_idxs_cum(cum_dist, shortlisted_idxs, off_start, off_end),
+            raga_feature.get_dist_btw_shortlisted_idxs(pitchvalue_prob, shortlisted_idxs, off_start, off_end))
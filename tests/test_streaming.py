@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+import raga_feature
+import streaming
+
+
+def get_pitchvalue_prob(rng, n):
+    # a random walk of notes, one hot with a small floor like the stretched CRePE output
+    walk = np.cumsum(rng.integers(-7, 8, n)) % 120
+    return np.eye(120)[walk] * 0.9 + 0.001 * rng.random([n, 120])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_streaming_spd_matches_full_spd_cache(seed):
+    rng = np.random.default_rng(seed)
+    pitchvalue_prob = get_pitchvalue_prob(rng, 4000)
+    spd = streaming.StreamingSPD()
+    n = 0
+    while n < len(pitchvalue_prob):
+        step = int(rng.integers(1, 600))
+        spd.update(pitchvalue_prob[n:n + step])
+        n = min(n + step, len(pitchvalue_prob))
+        if len(np.unique(np.argmax(pitchvalue_prob[:n], axis=1) // 10)) < 12:
+            # generate_full_spd_cache needs every note to occur
+            continue
+        full_spd_dist, dist_hist = spd.get_spd_cache()
+        ref_full_spd_dist, ref_dist_hist = raga_feature.generate_full_spd_cache(pitchvalue_prob[:n])
+        assert np.allclose(dist_hist, ref_dist_hist)
+        assert np.allclose(full_spd_dist, ref_full_spd_dist)
+    assert spd.n_frames == len(pitchvalue_prob)